@@ -0,0 +1,196 @@
+#! /usr/bin/env python3
+"""
+Generates norms in bulk, sharding the users across a pool of processes.
+
+Without --profiles it regenerates the norms of every database user, leaving the user out of their own
+neighbours. With --profiles it predicts the users of another csv with the layout of main_data.csv:
+
+    python BulkPredict.py --output norms.csv
+    python BulkPredict.py --profiles new_answers.csv --output norms.parquet --workers 8
+"""
+
+import argparse
+import multiprocessing
+import os
+import numpy as np
+import pandas as pd
+from DataLoader import Dataset, read_database
+from PrefPredict import PrefPredict, NORMS
+
+# The instance used by the workers. With the fork start method it is inherited from the parent, so the matrix
+# and its index are shared copy-on-write, otherwise every worker loads it, memory-mapping the binary cache.
+_pred = None
+_settings = None
+
+
+def _init_worker(path, settings):
+    global _pred, _settings
+    _settings = settings
+    if _pred is None:
+        # The thresholds come with the settings, the defaults of this instance are not used.
+        _pred = PrefPredict(0, 5, 5, path=path, backend="matrix")
+
+
+def _predict_shard(shard):
+    """
+    Predicts the norms of a shard of users in a worker.
+    :param shard: A list of tuples (user id, cols, vals, row), row being that of the user in the database
+    or None
+    :return: A DataFrame with a row per user and predicted preference
+    """
+    pred = _pred
+    frames = []
+    for u_id, cols, vals, row in shard:
+        if _settings["all_prefs"]:
+            pref_ids = pred.preference_ids
+        else:
+            known = set(cols.tolist())
+            pref_ids = [p_id for col, p_id in enumerate(pred.preference_ids) if col not in known]
+        ret = pred.predict_encoded(cols, vals, pref_ids, _settings["rho"], _settings["mu"],
+                                   _settings["max_dist"], _settings["min_common"], _settings["min_users_pred"],
+                                   _settings["neighbour_mode"], exclude=row)
+        blocks = pred.norm_blocks(ret["pred"], ret["conf"], _settings["useconf"])
+        ret["norm"] = pd.Series([NORMS[block] for block in blocks], index=ret.index, dtype=object)
+        ret = ret.reset_index()
+        ret.insert(0, "user_id", u_id)
+        frames.append(ret)
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+
+def database_queries(pred):
+    """
+    The queries to regenerate the norms of every database user, each excludes the row of its user.
+    :param pred: A PrefPredict instance
+    :return: A generator of tuples (user id, cols, vals, row)
+    """
+    for row, u_id in enumerate(pred.user_ids):
+        cols, vals = pred.matrix.encode_row(row)
+        yield u_id, cols, vals, row
+
+
+def profile_queries(pred, path):
+    """
+    The queries to predict the users of a csv with the layout of main_data.csv.
+    :param pred: A PrefPredict instance
+    :param path: The path of the csv with the profiles
+    :return: A generator of tuples (user id, cols, vals, None)
+    """
+    profiles = Dataset.from_frame(read_database(path), problematic=())
+    # The columns of the profiles may be ordered differently than those of the database.
+    to_col = np.array([pred.matrix.pref_index.get(p_id, -1) for p_id in profiles.preference_ids])
+    for row, u_id in enumerate(profiles.user_ids):
+        known = np.flatnonzero((profiles.values[row] > 0) & (to_col >= 0))
+        yield u_id, to_col[known], profiles.values[row, known].astype(np.int16), None
+
+
+def _shards(queries, size):
+    shard = []
+    for query in queries:
+        shard.append(query)
+        if len(shard) == size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+class _Writer:
+
+    def __init__(self, path):
+        """
+        Appends DataFrames to a csv or, if the path ends with .parquet, a parquet file (which needs pyarrow).
+        """
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        self.writer = None
+        self.header = True
+
+    def write(self, frame):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        else:
+            frame.to_csv(self.path, mode="w" if self.header else "a", header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def bulk_predict(output, pred=None, path="main_data.csv", profiles=None, workers=None, shard_size=16,
+                 all_prefs=False, useconf=True, rho=0.5, mu=0.5, max_dist=None, min_common=None,
+                 min_users_pred=None, neighbour_mode="radius"):
+    """
+    Predicts the norms of many users with a pool of processes and streams them to a file as shards finish,
+    in no particular order.
+    :param output: The path of the csv (or .parquet) file to write, with a row per user and preference
+    :param pred: A PrefPredict instance, loaded from path if None
+    :param path: The path of the privacy preferences database
+    :param profiles: The path of a csv with the users to predict, the database users (leave-one-out) if None
+    :param workers: The ammount of processes, one per core if None
+    :param shard_size: The ammount of users sent to a worker at once
+    :param all_prefs: If True every preference is predicted, also those the user answered, otherwise only the
+    unknown ones
+    :param useconf: A boolean indicating if we should use confidence in the prediction function
+    :param rho: A confidence weight, specifically the weight of the distance with the similar users
+    :param mu: A confidence weight, that of the standard deviation of the aggregated preferences
+    :param max_dist: The maximum distance for similar users, the default of pred if None
+    :param min_common: The minimum ammount of common preferences, the default of pred if None
+    :param min_users_pred: The minimum ammount of similar users, the default of pred if None
+    :param neighbour_mode: How similar users are chosen and aggregated, one of Neighbours.MODES
+    :return: The ammount of rows written
+    """
+    global _pred
+    if pred is None:
+        pred = PrefPredict(0, 5, 5, path=path, backend="matrix")
+    max_dist, min_common, min_users_pred = pred.thresholds(max_dist, min_common, min_users_pred)
+    settings = {"all_prefs": all_prefs, "useconf": useconf, "rho": rho, "mu": mu, "max_dist": max_dist,
+                "min_common": min_common, "min_users_pred": min_users_pred, "neighbour_mode": neighbour_mode}
+    queries = database_queries(pred) if profiles is None else profile_queries(pred, profiles)
+    context = multiprocessing.get_context()
+    if context.get_start_method() == "fork":
+        # The workers inherit the instance, nothing is pickled.
+        _pred = pred
+    writer = _Writer(output)
+    written = 0
+    try:
+        with context.Pool(workers, initializer=_init_worker, initargs=(pred.path, settings)) as pool:
+            for frame in pool.imap_unordered(_predict_shard, _shards(queries, shard_size)):
+                if frame is not None:
+                    writer.write(frame)
+                    written += len(frame)
+    finally:
+        writer.close()
+        _pred = None
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default="main_data.csv", help="the privacy preferences database")
+    parser.add_argument("--profiles", help="a csv with the users to predict, the database users if omitted")
+    parser.add_argument("--output", required=True, help="the csv or .parquet file to write")
+    parser.add_argument("--workers", type=int, help="the ammount of processes, one per core by default")
+    parser.add_argument("--shard-size", type=int, default=16, help="users sent to a worker at once")
+    parser.add_argument("--all-prefs", action="store_true", help="also predict the answered preferences")
+    parser.add_argument("--max-dist", type=float, default=0)
+    parser.add_argument("--min-common", type=int, default=5)
+    parser.add_argument("--min-users-pred", type=int, default=5)
+    parser.add_argument("--rho", type=float, default=0.5)
+    parser.add_argument("--mu", type=float, default=0.5)
+    parser.add_argument("--neighbour-mode", default="radius")
+    args = parser.parse_args()
+    pred = PrefPredict(args.max_dist, args.min_common, args.min_users_pred, path=args.data, backend="matrix")
+    written = bulk_predict(args.output, pred, profiles=args.profiles, workers=args.workers,
+                           shard_size=args.shard_size, all_prefs=args.all_prefs, rho=args.rho, mu=args.mu,
+                           neighbour_mode=args.neighbour_mode)
+    print(f"wrote {written} predictions to {os.path.abspath(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#! /usr/bin/env python3
+"""
+An approximate search of similar users for large databases. The users are grouped in clusters, and a query is
+only compared with the users of the clusters closest to it, instead of with every database user.
+
+The recall of the approximate search against the exact one can be measured on a sample of database users, for
+several values of the ammount of probed clusters, which trades recall for speed:
+
+    python ClusterIndex.py --clusters 64 --probe 1,2,4,8,16 --queries 200
+"""
+
+import argparse
+import hashlib
+import sys
+import time as t
+import numpy as np
+import pandas as pd
+from DataLoader import load_dataset
+from PrefMatrix import PrefMatrix
+
+
+class ClusterIndex:
+
+    def __init__(self, centroids, lists, n_probe=8):
+        """
+        An inverted file of the database users: the users of each cluster and its centroid.
+        :param centroids: A float array with one row per cluster and one column per preference
+        :param lists: A list with the rows of the users of each cluster, in database order
+        :param n_probe: The default ammount of clusters compared with a query, more clusters give a better
+        recall and a slower search
+        """
+        self.centroids = centroids
+        self.lists = lists
+        self.n_probe = n_probe
+        self.size = sum(len(rows) for rows in lists)
+        self._digest = hashlib.blake2b(centroids.tobytes(), digest_size=8).hexdigest()
+
+    @classmethod
+    def build(cls, values, clusters=64, n_probe=8, iterations=10, sample=20000, seed=0):
+        """
+        Clusters the database users with k-means. Only the known preferences of a user count for its distance
+        with the centroids, the mean squared difference between them, so the distances of all the users are
+        computed with two matrix products.
+        :param values: An int8 array with one row per user and one column per preference, in the scale 1-5 and
+        0 when unknown, e.g. Dataset.values
+        :param clusters: The ammount of clusters
+        :param n_probe: The default ammount of clusters compared with a query
+        :param iterations: The ammount of k-means iterations
+        :param sample: The maximum ammount of users the centroids are computed with, the others are only
+        assigned to them
+        :param seed: The seed of the random choices
+        :return: A ClusterIndex instance
+        """
+        rng = np.random.default_rng(seed)
+        values = np.asarray(values)
+        known = values > 0
+        train = np.arange(len(values))
+        if len(train) > sample:
+            train = np.sort(rng.choice(len(values), sample, replace=False))
+        train_values = values[train].astype(np.float32)
+        train_known = known[train].astype(np.float32)
+        clusters = max(1, min(clusters, len(train)))
+        # Unknown preferences of the initial centroids are the average answer
+        answered = train_known.sum(axis=0)
+        col_means = np.where(answered > 0, train_values.sum(axis=0) / np.maximum(answered, 1), 3.0)
+        init = rng.choice(len(train), clusters, replace=False)
+        centroids = np.where(train_known[init] > 0, train_values[init], col_means).astype(np.float32)
+        for i in range(iterations):
+            labels = _assign(train_values, train_known, centroids)
+            sums = np.zeros_like(centroids)
+            counts = np.zeros_like(centroids)
+            np.add.at(sums, labels, train_values)
+            np.add.at(counts, labels, train_known)
+            # Preferences nobody in a cluster knows (or empty clusters) keep their previous value
+            centroids = np.where(counts > 0, sums / np.maximum(counts, 1), centroids)
+        labels = np.concatenate([_assign(values[start:start + 4096].astype(np.float32),
+                                         known[start:start + 4096].astype(np.float32), centroids)
+                                 for start in range(0, len(values), 4096)] or [np.zeros(0, dtype=np.intp)])
+        return cls(centroids, _lists(labels, clusters), n_probe)
+
+    def key(self):
+        """
+        Describes the search, the predictions made with it are only those of the same index and n_probe.
+        :return: A tuple
+        """
+        return ("clusters", len(self.lists), self.n_probe, self._digest)
+
+    def candidates(self, cols, vals, n_probe=None):
+        """
+        Returns the rows of the database users in the clusters closest to a query.
+        :param cols: An array with the columns of the known preferences of the query, see PrefMatrix.encode
+        :param vals: An array with the values of the query for those columns
+        :param n_probe: The ammount of clusters, self.n_probe if None
+        :return: An array of rows, in database order
+        """
+        if n_probe is None:
+            n_probe = self.n_probe
+        if n_probe >= len(self.lists) or len(cols) == 0:
+            return np.arange(self.size)
+        scores = ((self.centroids[:, cols] - vals) ** 2).mean(axis=1)
+        probed = np.argpartition(scores, n_probe - 1)[:n_probe]
+        rows = np.concatenate([self.lists[c] for c in probed])
+        rows.sort()
+        return rows
+
+    def appended(self, values, start):
+        """
+        Returns an index with the users of this one and some new ones, assigned to the closest clusters. The
+        centroids are not updated, this one is not modified.
+        :param values: An int8 array with one row per new user, as in build
+        :param start: The row of the first new user
+        :return: A ClusterIndex instance
+        """
+        values = np.asarray(values)
+        labels = _assign(values.astype(np.float32), (values > 0).astype(np.float32), self.centroids)
+        lists = list(self.lists)
+        for c in np.unique(labels).tolist():
+            lists[c] = np.concatenate((lists[c], start + np.flatnonzero(labels == c)))
+        return ClusterIndex(self.centroids, lists, self.n_probe)
+
+    def check_recall(self, matrix, queries=100, k=10, min_common=5, answers=32, probes=None, seed=0):
+        """
+        Measures the recall of the approximate search against the exact one. Each query is a database user
+        (excluded from their own results) with only some of their answers known, as a user of /predict. The
+        recall is the share of the k closest users of the exact search found by the approximate one, users as
+        close as the k-th one counting as well.
+        :param matrix: The PrefMatrix the index was built from
+        :param queries: The ammount of database users used as queries, chosen at random
+        :param k: The ammount of closest users compared
+        :param min_common: The minimum ammount of common preferences, see PrefPredict.distance
+        :param answers: The ammount of known answers kept per query, all of them if None
+        :param probes: The values of n_probe to measure, powers of two up to the ammount of clusters if None
+        :param seed: The seed of the random choices
+        :return: A DataFrame with a row per n_probe: the recall, the share of the database compared with each
+        query, the milliseconds per query and the speedup over the exact search
+        """
+        rng = np.random.default_rng(seed)
+        if probes is None:
+            probes = sorted({2 ** i for i in range(len(self.lists).bit_length())} | {self.n_probe})
+        found = np.zeros(len(probes))
+        scanned = np.zeros(len(probes))
+        seconds = np.zeros(len(probes))
+        exact_seconds = 0.0
+        wanted = 0
+        evaluated = 0
+        for row in rng.choice(matrix.num_users(), min(queries, matrix.num_users()), replace=False):
+            cols, vals = matrix.encode_row(row)
+            if answers is not None and len(cols) > answers:
+                keep = np.sort(rng.choice(len(cols), answers, replace=False))
+                cols, vals = cols[keep], vals[keep]
+            start = t.perf_counter()
+            distances = matrix.distances(cols, vals, min_common)
+            exact_seconds += t.perf_counter() - start
+            distances[row] = np.inf
+            finite = distances[np.isfinite(distances)]
+            if len(finite) == 0:
+                continue
+            num = min(k, len(finite))
+            kth = np.partition(finite, num - 1)[num - 1]
+            wanted += num
+            evaluated += 1
+            for i, n_probe in enumerate(probes):
+                start = t.perf_counter()
+                rows = self.candidates(cols, vals, n_probe)
+                approx = matrix.distances(cols, vals, min_common, rows)
+                seconds[i] += t.perf_counter() - start
+                found[i] += min(num, int(np.count_nonzero(approx[rows != row] <= kth)))
+                scanned[i] += len(rows) / matrix.num_users()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return pd.DataFrame({
+                "n_probe": probes,
+                "recall": found / wanted,
+                "scanned": scanned / evaluated,
+                "ms": 1000 * seconds / evaluated,
+                "speedup": exact_seconds / seconds,
+            })
+
+
+def _assign(values, known, centroids):
+    # The closest centroid of each user by mean squared difference over their known preferences. Expanding the
+    # square, the term of the user alone is the same for every centroid and does not change the closest one.
+    scores = known @ (centroids ** 2).T - 2 * values @ centroids.T
+    return np.argmin(scores, axis=1)
+
+
+def _lists(labels, clusters):
+    # The rows of each cluster, in database order
+    order = np.argsort(labels, kind="stable")
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=clusters))))
+    return [order[bounds[c]:bounds[c + 1]] for c in range(clusters)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default="main_data.csv", help="the privacy preferences database")
+    parser.add_argument("--clusters", type=int, default=64, help="the ammount of clusters")
+    parser.add_argument("--probe", default=None, help="comma separated values of n_probe")
+    parser.add_argument("--queries", type=int, default=100, help="the ammount of database users used as queries")
+    parser.add_argument("--k", type=int, default=10, help="the ammount of closest users compared")
+    parser.add_argument("--min-common", type=int, default=5)
+    parser.add_argument("--answers", type=int, default=32, help="known answers per query, 0 for all of them")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    dataset = load_dataset(args.data)
+    matrix = PrefMatrix(dataset.values, dataset.preference_ids)
+    start = t.perf_counter()
+    index = ClusterIndex.build(dataset.values, args.clusters, seed=args.seed)
+    print(f"built {len(index.lists)} clusters of {index.size} users in {t.perf_counter() - start:.2f}s",
+          file=sys.stderr)
+    probes = None if args.probe is None else [int(value) for value in args.probe.split(",")]
+    results = index.check_recall(matrix, args.queries, args.k, args.min_common, args.answers or None, probes,
+                                 args.seed)
+    print(results.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
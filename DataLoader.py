@@ -0,0 +1,313 @@
+import glob
+import hashlib
+import json
+import math
+import os
+import numpy as np
+import pandas as pd
+from Demographics import database_demographics
+
+# The database has some errors in a few participants that break the code when making predictions.
+# We remove these participants.
+PROBLEMATIC_USERS = [168, 204, 218, 322, 795, 1124, 1153, 1154, 1240, 1445]
+
+
+def read_database(path="main_data.csv"):
+    """
+    Reads the privacy preferences database into a DataFrame.
+    :param path: The path of the csv file
+    :return: A DataFrame, the first row contains the text of the questions
+    """
+    return pd.read_csv(path, encoding="ISO-8859-1", low_memory=False)
+
+
+def num_answer(ans):
+    """
+    In the database the answers to the survey questions are in text for (e.g. "completely unacceptable")
+    Thi function transforms them into numbers from 1-5 as follows:
+    completely unacceptable -> 1, unacceptable -> 2, neutral -> 3, acceptable -> 4, completely acceptable -> 5
+    :param ans: A string containing the answer from the dataset
+    :return: An integer representing the anser, as detailed above
+    """
+    ans = ans.lower().replace(" ", "")
+    num = math.nan
+    if "unacceptable" in ans:
+        if "completely" in ans:
+            #This is the case "completely unacceptable"
+            num = 1
+        else:
+            # This is the case "unacceptable"
+            num = 2
+    elif "acceptable" in ans:
+        if "completely" in ans:
+            # This is the case "completely acceptable"
+            num = 5
+        else:
+            # This is the case "unacceptable"
+            num = 4
+    if "neutral" in ans:
+        # This is the case "neutral"
+        num = 3
+    return num
+
+
+def get_preference_ids(columns):
+    """
+    Selects the preference ids among the columns of the database. These ids are strings containing the
+    names of the questions from which the preferences were gathered, for example, "Q12_1".
+    :param columns: The column names of the database
+    :return: A list of strings.
+    """
+    #Only questions up to Q147 are related to preferences, later questions are related to demografics.
+    return [id for id in columns if int(id.split("_")[0].replace("Q", "")) < 148]
+
+
+def file_hash(path):
+    """
+    Returns a digest of the content of a file, used to know if a cache was built from it.
+    :param path: The path of the file
+    :return: A string with the hexadecimal digest
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Dataset:
+
+    def __init__(self, values, preference_ids, user_ids, questions, version, log_offset=0, log_check="",
+                 demographics=None, participants=None):
+        """
+        The preferences of the database in numerical form, ready to build a PrefMatrix.
+        :param values: An int8 array with one row per user and one column per preference, with the preferences
+        in the scale 1-5 and 0 when unknown
+        :param preference_ids: A list with the preference id of each column
+        :param user_ids: A list with the user id of each row
+        :param questions: A dictionary with the text of every question of the database, by column name
+        :param version: A string identifying the content the dataset was built from
+        :param log_offset: The offset of the ingestion log (see IngestLog) up to which its users are included,
+        after those of the csv
+        :param log_check: The checksum of the log at log_offset, see IngestLog.checksum
+        :param demographics: A dictionary {user id: demographics} with every ingested user, an empty dictionary
+        if their demographics are unknown, and the users of the csv whose demographics are among the questions
+        of the database (see Demographics.database_demographics). Those of the others are in demographics.csv
+        :param participants: The ammount of participants of the csv, including those left out, the length of
+        demographics.csv. The ammount of users if None
+        """
+        self.values = values
+        self.preference_ids = list(preference_ids)
+        self.user_ids = list(user_ids)
+        self.questions = questions
+        self.version = version
+        self.log_offset = log_offset
+        self.log_check = log_check
+        self.demographics = demographics if demographics is not None else {}
+        self.participants = participants if participants is not None else len(self.user_ids)
+
+    @classmethod
+    def from_frame(cls, frame, version=None, problematic=PROBLEMATIC_USERS):
+        """
+        Parses the answers of a DataFrame read with read_database.
+        :param frame: A DataFrame of the database, its first row contains the text of the questions
+        :param version: A string identifying the content of the frame, computed from the values if None
+        :param problematic: The ids of the users to leave out, those of the privacy preferences database by
+        default
+        :return: A Dataset instance
+        """
+        preference_ids = get_preference_ids(frame.columns)
+        # The first row holds the questions, users come after it and their id is their row.
+        user_ids = [u_id for u_id in range(1, len(frame)) if u_id not in problematic]
+        cells = frame.loc[user_ids, preference_ids].to_numpy(dtype=object).ravel()
+        # There are only a few distinct answers, we parse each of them once and map all the cells at once.
+        codes, answers = pd.factorize(cells)
+        parsed = [num_answer(ans) if isinstance(ans, str) else math.nan for ans in answers]
+        # Answers that cannot be parsed are considered unknown, as missing ones.
+        lookup = np.array([0 if math.isnan(num) else num for num in parsed] + [0], dtype=np.int8)
+        values = lookup[codes].reshape(len(user_ids), len(preference_ids))
+        questions = {col: str(text) for col, text in frame.iloc[0].items()}
+        demographics = database_demographics(frame, user_ids, preference_ids)
+        if version is None:
+            digest = hashlib.sha1(values.tobytes())
+            digest.update("\n".join(preference_ids).encode())
+            version = digest.hexdigest()
+        return cls(values, preference_ids, user_ids, questions, version, demographics=demographics,
+                   participants=len(frame) - 1)
+
+    def save(self, prefix):
+        """
+        Writes the dataset as prefix.npy (the matrix) and prefix.json (everything else). Files are first
+        written with a temporary name, so readers never see them half written.
+        :param prefix: The path of the files without extension
+        """
+        # Processes may write the same cache at once (e.g. compacting the ingestion log), each with its own files
+        tmp = f"{prefix}.{os.getpid()}.tmp"
+        np.save(tmp + ".npy", np.ascontiguousarray(self.values))
+        with open(tmp + ".json", "w") as f:
+            json.dump({"version": self.version, "preference_ids": self.preference_ids,
+                       "user_ids": self.user_ids, "questions": self.questions, "log_offset": self.log_offset,
+                       "log_check": self.log_check, "demographics": self.demographics,
+                       "participants": self.participants}, f)
+        os.replace(tmp + ".npy", prefix + ".npy")
+        os.replace(tmp + ".json", prefix + ".json")
+
+    @classmethod
+    def load(cls, prefix, mmap=True):
+        """
+        Reads a dataset written by save.
+        :param prefix: The path of the files without extension
+        :param mmap: If True the matrix is memory-mapped read-only, so processes share its pages
+        :return: A Dataset instance
+        """
+        with open(prefix + ".json") as f:
+            meta = json.load(f)
+        values = np.load(prefix + ".npy", mmap_mode="r" if mmap else None)
+        if len(values) != len(meta["user_ids"]):
+            # The files are replaced one after the other, we read them in between
+            raise ValueError(f"The cache {prefix} is being written")
+        if "participants" not in meta:
+            # Written by a previous version, the demographics of the users of the csv are missing
+            raise ValueError(f"The cache {prefix} is outdated")
+        # JSON keys are strings, user ids are integers
+        demographics = {int(u_id): d for u_id, d in meta.get("demographics", {}).items()}
+        return cls(values, meta["preference_ids"], meta["user_ids"], meta["questions"], meta["version"],
+                   meta.get("log_offset", 0), meta.get("log_check", ""), demographics, meta["participants"])
+
+
+def cache_prefix(path, version, cache_dir=None):
+    """
+    Returns the prefix of the cache files of a csv database for a given content.
+    :param path: The path of the csv file
+    :param version: The hash of the content of the csv file
+    :param cache_dir: The directory of the cache, that of the csv file if None
+    :return: A string path without extension
+    """
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(path))
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{stem}.{version[:16]}")
+
+
+def load_dataset(path="main_data.csv", cache=True, cache_dir=None, mmap=True):
+    """
+    Loads the database, from the binary cache if it was built from the same csv content, otherwise the csv
+    is parsed and the cache is written for the next time.
+    :param path: The path of the csv file
+    :param cache: A boolean, False to always parse the csv and never write a cache
+    :param cache_dir: The directory of the cache, that of the csv file if None
+    :param mmap: If True the cached matrix is memory-mapped read-only
+    :return: A Dataset instance
+    """
+    version = file_hash(path)
+    prefix = cache_prefix(path, version, cache_dir)
+    if cache and os.path.exists(prefix + ".json"):
+        try:
+            return Dataset.load(prefix, mmap)
+        except (OSError, ValueError):
+            # A damaged cache is rebuilt below.
+            pass
+    dataset = Dataset.from_frame(read_database(path), version)
+    if cache:
+        try:
+            # Caches of previous contents of the csv are no longer needed.
+            for old in glob.glob(cache_prefix(path, "*", cache_dir) + ".*"):
+                if not old.startswith(prefix):
+                    os.remove(old)
+            dataset.save(prefix)
+        except OSError:
+            # The cache is only an optimization, e.g. the directory may be read-only.
+            pass
+    return dataset
+
+
+def log_path(path):
+    """
+    Returns the path of the ingestion log of a csv database, next to it.
+    :param path: The path of the csv file
+    :return: A string path
+    """
+    # Not named like the cache files, load_dataset removes those of other versions
+    return os.path.splitext(path)[0] + "_ingest.jsonl"
+
+
+class IngestLog:
+
+    def __init__(self, path):
+        """
+        An append-only log of the respondents added to a database while it is in use, one JSON object per line.
+        The users of a dataset are those of its csv followed by those of the log, in order, so every process
+        reading the log ends up with the same users and ids. The log is compacted into the binary cache of the
+        csv (see Dataset.log_offset), so loading only reads the lines written since.
+        :param path: The path of the log, see log_path
+        """
+        self.path = path
+
+    def append(self, record):
+        """
+        Adds a record at the end of the log.
+        :param record: A dictionary that can be written as JSON
+        :return: The offset of the end of the record in the log
+        """
+        line = (json.dumps(record, sort_keys=True) + "\n").encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # A single write at the end of the file, lines of other processes are never interleaved with it
+            os.write(fd, line)
+            return os.lseek(fd, 0, os.SEEK_CUR)
+        finally:
+            os.close(fd)
+
+    def size(self):
+        """
+        Returns the size of the log, the offset the next record will start at.
+        :return: An integer, 0 if there is no log
+        """
+        try:
+            return os.stat(self.path).st_size
+        except OSError:
+            return 0
+
+    def checksum(self, offset):
+        """
+        Returns a checksum of the end of the log up to an offset, to know if a dataset compacted up to there
+        still matches the log (e.g. the log was not removed after being merged into the csv).
+        :param offset: The offset of the end of a record
+        :return: A string with the hexadecimal digest, None if the log is shorter than offset
+        """
+        start = max(0, offset - 256)
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(start)
+                data = f.read(offset - start)
+        except OSError:
+            data = b""
+        if len(data) < offset - start:
+            return None
+        return hashlib.sha1(data).hexdigest()
+
+    def read(self, offset=0):
+        """
+        Reads the records written after an offset. A line that is still being written is left for later.
+        :param offset: The offset to start reading at, that of the end of a record
+        :return: A tuple (entries, offset), a list of tuples (end offset, record) and the offset up to which the
+        log was read
+        """
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except OSError:
+            return [], offset
+        entries = []
+        end = offset
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break
+            end += len(line)
+            try:
+                entries.append((end, json.loads(line)))
+            except ValueError:
+                # A damaged line is skipped, by every reader alike
+                pass
+        return entries, end
\ No newline at end of file
@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+
+# The columns of demographics.csv we use, by the name used in queries (e.g. the parameters of /predict).
+FIELDS = {
+    "spa_owner": "Are you a Smart Home Personal Assistant (SPA) user or owner",
+    "age": "Age",
+    "gender": "Gender identity",
+    "employment": "Employment Status",
+    "education": "Highest education level completed",
+}
+# The lower bound of each age band, the last band has no upper bound
+AGE_BANDS = (18, 25, 35, 45, 55)
+
+
+def age_band(age):
+    """
+    Returns the age band of an age, e.g. "25-34".
+    :param age: A number, or a string with a number
+    :return: A string, None if the age is unknown or under the first band
+    """
+    try:
+        age = float(age)
+    except (TypeError, ValueError):
+        return None
+    if np.isnan(age) or age < AGE_BANDS[0]:
+        return None
+    for low, high in zip(AGE_BANDS, AGE_BANDS[1:]):
+        if age < high:
+            return f"{low}-{high - 1}"
+    return f"{AGE_BANDS[-1]}+"
+
+
+def _text(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    # Answers are compared case insensitively, e.g. "yes" is the segment of "Yes"
+    return str(value).strip().lower() or None
+
+
+# The ways of partitioning the users, each maps the demographics of a user (a dictionary by FIELDS name) to
+# their segment, None when unknown.
+SEGMENTERS = {
+    "spa_owner": lambda d: _text(d.get("spa_owner")),
+    "age_band": lambda d: age_band(d.get("age")),
+    "gender": lambda d: _text(d.get("gender")),
+    "employment": lambda d: _text(d.get("employment")),
+    "education": lambda d: _text(d.get("education")),
+}
+
+
+def segment_of(demographics, by):
+    """
+    Returns the segment of a user given their demographics.
+    :param demographics: A dictionary by FIELDS name, e.g. {"spa_owner": "Yes", "age": 30}
+    :param by: The names of the segmenters, see SEGMENTERS
+    :return: A tuple with a value per segmenter, None if some of them is unknown
+    """
+    label = tuple(SEGMENTERS[name](demographics) for name in by)
+    return None if None in label else label
+
+
+def _field_columns(texts):
+    # The column of each field of FIELDS, the first one whose text (a header or a question) starts with its own
+    renames = {}
+    for name, header in FIELDS.items():
+        for col, text in texts.items():
+            if str(text).startswith(header):
+                renames[col] = name
+                break
+    return renames
+
+
+def read_demographics(path="demographics.csv", participants=None):
+    """
+    Reads the demographics of the participants, with the columns of FIELDS renamed to their short names.
+    The file has no id column: its row i holds the participant of row i + 1 of the privacy preferences
+    database, whose user id is i + 1 (the first row of the database holds the questions).
+    :param path: The path of the csv file
+    :param participants: The ammount of participants of the database (see DataLoader.Dataset.participants), to
+    check that the file has a row for each of them. Not checked if None
+    :return: A DataFrame indexed by user id
+    :raise ValueError: If the file does not have a row per participant, its rows cannot be matched to them
+    """
+    frame = pd.read_csv(path, encoding="ISO-8859-1")
+    if participants is not None and len(frame) != participants:
+        raise ValueError(f"{path} has {len(frame)} rows but the database has {participants} participants, "
+                         f"its rows cannot be matched to them")
+    frame = frame.rename(columns=_field_columns({col: col for col in frame.columns}))
+    frame.index = pd.RangeIndex(1, len(frame) + 1, name="user_id")
+    return frame
+
+
+def database_demographics(frame, user_ids, preference_ids):
+    """
+    Reads the demographics of the participants from the privacy preferences database itself, from its
+    demographic questions (those that are not preferences) whose text starts with the header of a field of
+    FIELDS.
+    :param frame: A DataFrame of the database (see DataLoader.read_database), its first row contains the text of
+    the questions
+    :param user_ids: The ids of the users to read, their row in frame
+    :param preference_ids: The columns of the preferences, the other ones are demographic questions
+    :return: A dictionary {user id: demographics}, with the fields found in the database only. Empty if the
+    database has none of them
+    """
+    preferences = set(preference_ids)
+    renames = _field_columns({col: text for col, text in frame.iloc[0].items() if col not in preferences})
+    if not renames:
+        return {}
+    # The values are written as they are read, so they can be stored as JSON (see DataLoader.Dataset.save)
+    records = frame.loc[user_ids, list(renames)].rename(columns=renames).astype(object)
+    records = records.where(records.notna(), None).to_dict("index")
+    return {int(u_id): {name: value for name, value in record.items() if value is not None}
+            for u_id, record in records.items()}
+
+
+def _comparable(name, value):
+    # The value of a field as compared between the file and the database, None if unknown, e.g. the ages 30 and
+    # "30.0" or the answers "Yes" and "yes" are the same
+    if name == "age":
+        try:
+            age = float(value)
+        except (TypeError, ValueError):
+            return None
+        return None if np.isnan(age) else age
+    return _text(value)
+
+
+def _check_join(records, known):
+    # Raises if the demographics of a participant in the file differ from those in the database for some field
+    for u_id, demographics in known.items():
+        record = records.get(u_id)
+        if record is None:
+            continue
+        for name, value in demographics.items():
+            if name not in record:
+                continue
+            ours, theirs = _comparable(name, value), _comparable(name, record[name])
+            if ours is not None and theirs is not None and ours != theirs:
+                raise ValueError(f"The {name} of user {u_id} is {record[name]} in the demographics file but "
+                                 f"{value} in the database, its rows are not those of the participants")
+
+
+class SegmentIndex:
+
+    def __init__(self, labels, by):
+        """
+        Partitions the rows of a PrefMatrix by demographic segment, so queries can look for similar users in
+        their own segment.
+        :param labels: A list with the segment of each row of the matrix, a tuple with a value per segmenter,
+        None for the users whose demographics are unknown
+        :param by: The names of the segmenters (see SEGMENTERS) the labels were built with
+        """
+        self.by = tuple(by)
+        self.labels = list(labels)
+        self.build_masks()
+
+    def build_masks(self):
+        """
+        Builds, for every segment, the mask of its rows.
+        """
+        self.masks = {}
+        for row, label in enumerate(self.labels):
+            if label is None:
+                continue
+            if label not in self.masks:
+                self.masks[label] = np.zeros(len(self.labels), dtype=bool)
+            self.masks[label][row] = True
+
+    @classmethod
+    def from_csv(cls, path, user_ids, by=("spa_owner", "age_band"), extra=None, participants=None):
+        """
+        Builds the index from demographics.csv, see read_demographics for how its rows match the users. Where
+        extra has the demographics of a participant (those read from the database, see database_demographics),
+        they are checked to be those of the row of the file.
+        :param path: The path of the csv file
+        :param user_ids: The user id of each row of the matrix, e.g. Dataset.user_ids
+        :param by: The names of the segmenters to partition by, see SEGMENTERS
+        :param extra: A dictionary {user id: demographics} of users whose demographics are known without the
+        file, e.g. Dataset.demographics. Those of the file are only used for the fields they lack.
+        :param participants: The ammount of participants of the database, see read_demographics
+        :return: A SegmentIndex instance
+        :raise ValueError: If the rows of the file cannot be those of the participants of the database
+        """
+        for name in by:
+            if name not in SEGMENTERS:
+                raise ValueError(f"Unknown segmenter {name}")
+        frame = read_demographics(path, participants)
+        columns = [name for name in FIELDS if name in frame.columns]
+        records = frame[columns].to_dict("index")
+        extra = extra or {}
+        _check_join(records, extra)
+        labels = []
+        for u_id in user_ids:
+            demographics = dict(records.get(u_id, {}))
+            demographics.update(extra.get(u_id, {}))
+            labels.append(segment_of(demographics, by))
+        return cls(labels, by)
+
+    def appended(self, demographics):
+        """
+        Returns an index with the rows of this one followed by some new users, this one is not modified.
+        :param demographics: A list with the demographics of each new user, a dictionary by FIELDS name
+        :return: A SegmentIndex instance
+        """
+        labels = [self.segment(d) for d in demographics]
+        new = SegmentIndex.__new__(SegmentIndex)
+        new.by = self.by
+        new.labels = self.labels + labels
+        new.masks = {}
+        size = len(new.labels)
+        for label in set(self.masks).union(labels):
+            if label is None:
+                continue
+            mask = np.zeros(size, dtype=bool)
+            if label in self.masks:
+                mask[:len(self.labels)] = self.masks[label]
+            mask[len(self.labels):] = [new_label == label for new_label in labels]
+            new.masks[label] = mask
+        return new
+
+    def segment(self, demographics):
+        """
+        Returns the segment of a user given their demographics.
+        :param demographics: A dictionary by FIELDS name, e.g. {"spa_owner": "Yes", "age": 30}, other keys are
+        ignored
+        :return: A tuple with a value per segmenter, None if some of them is unknown
+        """
+        return segment_of(demographics, self.by)
+
+    def mask(self, label):
+        """
+        Returns the mask of the rows of a segment.
+        :param label: A segment, as returned by segment
+        :return: A boolean array with an entry per row of the matrix, None if nobody is in the segment
+        """
+        return self.masks.get(label)
+
+    def sizes(self):
+        """
+        Returns the ammount of users of each segment.
+        :return: A dictionary {segment: ammount}
+        """
+        return {label: int(mask.sum()) for label, mask in self.masks.items()}
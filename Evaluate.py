@@ -0,0 +1,194 @@
+#! /usr/bin/env python3
+"""
+Evaluates the accuracy of the predictions over a grid of thresholds and confidence weights.
+
+The database users are split in folds. For each user of a fold part of their answers are hidden and predicted
+from the rest, using only the users of the other folds as neighbours. The distances of a held-out user are
+computed once and reused by every setting of the grid. Partial results are printed as JSON lines after each
+fold, so long sweeps can be watched (and stopped) as they go:
+
+    python Evaluate.py --folds 10 --max-dist 0,0.5,1 --min-common 3,5 --min-users-pred 3,5,10
+"""
+
+import argparse
+import itertools
+import json
+import sys
+import numpy as np
+import pandas as pd
+from PrefMatrix import parts_to_distances
+from PrefPredict import PrefPredict
+from Neighbours import check_mode
+
+SETTINGS = ["max_dist", "min_common", "min_users_pred", "rho", "mu"]
+
+
+def true_blocks(values):
+    """
+    The norm blocks (see PrefPredict.norm_block) of known answers: 1 and 2 are prohibitions, 3 is unclear and
+    4 and 5 are permissions.
+    :param values: An array of answers in the scale 1-5
+    :return: An integer array of blocks 1-3
+    """
+    return np.select([values <= 2, values == 3], [1, 2], 3)
+
+
+class _Totals:
+
+    def __init__(self, size):
+        """
+        Running totals of the metrics of every setting of the grid.
+        """
+        self.targets = np.zeros(size)
+        self.predicted = np.zeros(size)
+        self.abs_error = np.zeros(size)
+        self.correct = np.zeros(size)
+        self.covered = np.zeros(size)
+        self.covered_correct = np.zeros(size)
+        self.users = 0
+
+    def add(self, setting, count, pred, blocks, true, truth_blocks):
+        self.targets[setting] += len(true)
+        # Nobody else knows some targets, they have no prediction and count as unclear norms.
+        predicted = count > 0
+        self.predicted[setting] += predicted.sum()
+        self.abs_error[setting] += np.abs(pred[predicted] - true[predicted]).sum()
+        self.correct[setting] += (blocks == truth_blocks).sum()
+        covered = blocks != 2
+        self.covered[setting] += covered.sum()
+        self.covered_correct[setting] += (blocks[covered] == truth_blocks[covered]).sum()
+
+    def frame(self, grid):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return pd.DataFrame({
+                **{name: [setting[i] for setting in grid] for i, name in enumerate(SETTINGS)},
+                "mae": self.abs_error / self.predicted,
+                "norm_accuracy": self.correct / self.targets,
+                "norm_precision": self.covered_correct / self.covered,
+                "coverage": self.covered / self.targets,
+                "targets": self.targets.astype(int),
+                "predicted": self.predicted.astype(int),
+            })
+
+
+def hide_answers(cols, hide, rng):
+    """
+    Chooses which of the known answers of a user are hidden.
+    :param cols: An array with the columns of the known preferences of the user
+    :param hide: The fraction of them to hide
+    :param rng: A numpy random generator
+    :return: A tuple (visible, hidden) of column arrays, or None if the user has less than two answers
+    """
+    if len(cols) < 2:
+        return None
+    num_hidden = min(len(cols) - 1, max(1, int(round(hide * len(cols)))))
+    shuffled = rng.permutation(cols)
+    return np.sort(shuffled[num_hidden:]), np.sort(shuffled[:num_hidden])
+
+
+def iter_evaluate(pred, max_dist=(0,), min_common=(5,), min_users_pred=(5,), rho=(0.5,), mu=(0.5,), folds=10,
+                  hide=0.5, users=None, neighbour_mode="radius", useconf=True, seed=0):
+    """
+    Evaluates every combination of the given settings, fold by fold.
+    :param pred: A PrefPredict instance
+    :param max_dist: The values of max_dist to evaluate
+    :param min_common: The values of min_common to evaluate
+    :param min_users_pred: The values of min_users_pred to evaluate
+    :param rho: The values of the confidence weight rho to evaluate
+    :param mu: The values of the confidence weight mu to evaluate
+    :param folds: The ammount of folds, the ammount of evaluated users for leave-one-out
+    :param hide: The fraction of the answers of a held-out user that are hidden and predicted
+    :param users: The ammount of database users to evaluate, chosen at random, all of them if None
+    :param neighbour_mode: How similar users are chosen and aggregated, one of Neighbours.MODES
+    :param useconf: A boolean indicating if we should use confidence in the prediction function
+    :param seed: The seed of the random choices (users, folds and hidden answers)
+    :return: A generator of tuples (evaluated users, DataFrame), the DataFrame has a row per setting with the
+    mean absolute error of the predicted targets, the accuracy of the norms (unclear counts as a norm), the
+    precision of the produced norms and the coverage (share of predictions producing a norm) so far
+    """
+    check_mode(neighbour_mode)
+    rng = np.random.default_rng(seed)
+    matrix = pred.matrix
+    rows = rng.permutation(matrix.num_users())
+    if users is not None:
+        rows = rows[:users]
+    grid = list(itertools.product(max_dist, min_common, min_users_pred, rho, mu))
+    index = {setting: i for i, setting in enumerate(grid)}
+    totals = _Totals(len(grid))
+    everyone = np.arange(matrix.num_users())
+    for fold in np.array_split(rows, min(folds, len(rows))):
+        # The users of the fold are not neighbours of anybody while it is evaluated.
+        candidates = np.setdiff1d(everyone, fold)
+        for row in fold:
+            split = hide_answers(matrix.encode_row(row)[0], hide, rng)
+            if split is None:
+                continue
+            visible, hidden = split
+            vals = matrix.values[row, visible].astype(np.int16)
+            true = matrix.values[row, hidden].astype(float)
+            truth_blocks = true_blocks(true)
+            # The only expensive part, done once per user for the whole grid
+            sums, common = matrix.distance_parts(visible, vals, candidates)
+            for mc in min_common:
+                distances = parts_to_distances(sums, common, mc)
+                for md, mup in itertools.product(max_dist, min_users_pred):
+                    count, mean, std, mean_dis = matrix.neighbour_stats(distances, hidden, md, mup, candidates,
+                                                                        neighbour_mode)
+                    for r, m in itertools.product(rho, mu):
+                        conf = 1 - r * np.minimum(1.0, mean_dis) - m * np.minimum(1.0, std)
+                        blocks = pred.norm_blocks(mean, conf, useconf)
+                        totals.add(index[(md, mc, mup, r, m)], count, mean, blocks, true, truth_blocks)
+            totals.users += 1
+        yield totals.users, totals.frame(grid)
+
+
+def evaluate(pred, **kwargs):
+    """
+    Same as iter_evaluate, only returning the final results.
+    :param pred: A PrefPredict instance
+    :param kwargs: The arguments of iter_evaluate
+    :return: The DataFrame of the last fold of iter_evaluate
+    """
+    results = None
+    for users, results in iter_evaluate(pred, **kwargs):
+        pass
+    return results
+
+
+def _values(text, cast):
+    return tuple(cast(value) for value in text.split(","))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default="main_data.csv", help="the privacy preferences database")
+    parser.add_argument("--max-dist", default="0", help="comma separated values")
+    parser.add_argument("--min-common", default="5", help="comma separated values")
+    parser.add_argument("--min-users-pred", default="5", help="comma separated values")
+    parser.add_argument("--rho", default="0.5", help="comma separated values")
+    parser.add_argument("--mu", default="0.5", help="comma separated values")
+    parser.add_argument("--folds", type=int, default=10, help="the ammount of folds")
+    parser.add_argument("--loo", action="store_true", help="leave-one-out, one fold per user")
+    parser.add_argument("--hide", type=float, default=0.5, help="fraction of the answers hidden per user")
+    parser.add_argument("--users", type=int, help="evaluate only this many random users")
+    parser.add_argument("--neighbour-mode", default="radius")
+    parser.add_argument("--no-conf", action="store_true", help="do not use confidence to produce norms")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the final results to this csv")
+    args = parser.parse_args()
+    pred = PrefPredict(0, 5, 5, path=args.data, backend="matrix")
+    folds = len(pred.user_ids) if args.loo else args.folds
+    results = None
+    for users, results in iter_evaluate(pred, _values(args.max_dist, float), _values(args.min_common, int),
+                                        _values(args.min_users_pred, int), _values(args.rho, float),
+                                        _values(args.mu, float), folds, args.hide, args.users,
+                                        args.neighbour_mode, not args.no_conf, args.seed):
+        print(json.dumps({"users": users, "results": results.to_dict(orient="records")}), flush=True)
+    if results is not None:
+        print(results.to_string(index=False), file=sys.stderr)
+        if args.output:
+            results.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
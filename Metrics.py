@@ -0,0 +1,267 @@
+import atexit
+import contextlib
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time as t
+import numpy as np
+
+# Upper bounds of the buckets of the histograms, the last bucket (+Inf) is implicit.
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class _Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Metrics:
+
+    def __init__(self, prefix="norm_prediction"):
+        """
+        Counters, histograms and timing spans of a process, rendered in the Prometheus text format. Metrics are
+        declared once (counter, histogram, gauge) and then updated with any labels, from any thread.
+        :param prefix: A prefix for the names of all the metrics
+        """
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # name -> (type, help, buckets or callback)
+        self._declared = {}
+        # name -> {labels: value or _Histogram}
+        self._values = {}
+        self._trace = threading.local()
+        self.histogram("span_seconds", "Duration of the steps of the requests.")
+
+    def counter(self, name, help):
+        """
+        Declares a counter.
+        :param name: The name of the counter, without the prefix
+        :param help: A description of the counter
+        """
+        self._declare(name, "counter", help, None)
+
+    def histogram(self, name, help, buckets=SECONDS_BUCKETS):
+        """
+        Declares a histogram.
+        :param name: The name of the histogram, without the prefix
+        :param help: A description of the histogram
+        :param buckets: The upper bounds of the buckets, in increasing order
+        """
+        self._declare(name, "histogram", help, tuple(buckets))
+
+    def gauge(self, name, help, callback):
+        """
+        Declares a gauge whose values are read when the metrics are rendered.
+        :param name: The name of the gauge, without the prefix
+        :param help: A description of the gauge
+        :param callback: A function without arguments returning a dictionary {labels: value}, labels being a
+        tuple of (name, value) pairs, () if there are none
+        """
+        self._declare(name, "gauge", help, callback)
+
+    def _declare(self, name, kind, help, extra):
+        with self._lock:
+            self._declared[name] = (kind, help, extra)
+            self._values.setdefault(name, {})
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increments a counter.
+        :param name: The name of a declared counter
+        :param value: The increment
+        :param labels: The labels of the series to increment
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Adds an observation to a histogram.
+        :param name: The name of a declared histogram
+        :param value: The observed value
+        :param labels: The labels of the series
+        """
+        self.observe_many(name, [value], **labels)
+
+    def observe_many(self, name, values, **labels):
+        """
+        Adds many observations to a histogram at once, e.g. the neighbour counts of a batch of predictions.
+        :param name: The name of a declared histogram
+        :param values: An iterable or array of observed values
+        :param labels: The labels of the series
+        """
+        values = np.asarray(values, dtype=float)
+        buckets = self._declared[name][2]
+        # The bucket of each value is the first bound that is not smaller than it
+        per_bucket = np.bincount(np.searchsorted(buckets, values, side="left"), minlength=len(buckets) + 1)
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = _Histogram(buckets)
+            for i, n in enumerate(per_bucket):
+                hist.counts[i] += int(n)
+            hist.sum += float(values.sum())
+            hist.count += len(values)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Times a step of a request, recording its duration in the span_seconds histogram and, if the thread is
+        inside trace(), in its timings.
+        :param name: The name of the step
+        """
+        start = t.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = t.perf_counter() - start
+            self.observe("span_seconds", elapsed, span=name)
+            timings = getattr(self._trace, "timings", None)
+            if timings is not None:
+                timings[name] = timings.get(name, 0.0) + elapsed
+
+    @contextlib.contextmanager
+    def trace(self):
+        """
+        Collects the spans of the current thread, e.g. those of a request, to log them.
+        :return: A dictionary {span name: seconds}, filled as the spans finish
+        """
+        previous = getattr(self._trace, "timings", None)
+        self._trace.timings = {}
+        try:
+            yield self._trace.timings
+        finally:
+            self._trace.timings = previous
+
+    def snapshot(self, since=None):
+        """
+        Copies the values of the counters and histograms, e.g. to send those of a worker process to another
+        process, which adds them to its own with merge.
+        :param since: An earlier snapshot of these metrics, to only copy what changed after it
+        :return: A dictionary {name: {labels: value}}, the value of a histogram being a tuple (buckets, counts,
+        sum, count)
+        """
+        with self._lock:
+            values = {name: {labels: (value.buckets, list(value.counts), value.sum, value.count)
+                             if isinstance(value, _Histogram) else value for labels, value in series.items()}
+                      for name, series in self._values.items() if self._declared[name][0] != "gauge"}
+        if since is None:
+            return values
+        changes = {}
+        for name, series in values.items():
+            for labels, value in series.items():
+                old = since.get(name, {}).get(labels)
+                if old is not None:
+                    if isinstance(value, tuple):
+                        value = (value[0], [n - m for n, m in zip(value[1], old[1])], value[2] - old[2],
+                                 value[3] - old[3])
+                    else:
+                        value = value - old
+                if value != 0 and not (isinstance(value, tuple) and value[3] == 0):
+                    changes.setdefault(name, {})[labels] = value
+        return changes
+
+    def merge(self, values):
+        """
+        Adds the values of a snapshot to these metrics. Those not declared here are ignored.
+        :param values: A dictionary returned by snapshot, usually of the metrics of another process
+        """
+        with self._lock:
+            for name, series in values.items():
+                if self._declared.get(name, (None,))[0] not in ("counter", "histogram"):
+                    continue
+                current = self._values[name]
+                for labels, value in series.items():
+                    if not isinstance(value, tuple):
+                        current[labels] = current.get(labels, 0) + value
+                        continue
+                    buckets, counts, total, count = value
+                    hist = current.get(labels)
+                    if hist is None:
+                        hist = current[labels] = _Histogram(buckets)
+                    for i, n in enumerate(counts):
+                        hist.counts[i] += n
+                    hist.sum += total
+                    hist.count += count
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text exposition format.
+        :return: A string
+        """
+        lines = []
+        with self._lock:
+            declared = dict(self._declared)
+            # Histograms keep changing, we copy their counts
+            values = {name: {labels: (value.buckets, list(value.counts), value.sum, value.count)
+                             if isinstance(value, _Histogram) else value for labels, value in series.items()}
+                      for name, series in self._values.items()}
+        for name, (kind, help, extra) in declared.items():
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full} {help}")
+            lines.append(f"# TYPE {full} {kind}")
+            if kind == "gauge":
+                for labels, value in extra().items():
+                    lines.append(f"{full}{_labels(labels)} {_number(value)}")
+            elif kind == "counter":
+                for labels, value in values[name].items():
+                    lines.append(f"{full}{_labels(labels)} {_number(value)}")
+            else:
+                for labels, (buckets, counts, total, count) in values[name].items():
+                    cumulative = 0
+                    for bound, n in zip(list(buckets) + ["+Inf"], counts):
+                        cumulative += n
+                        le = bound if bound == "+Inf" else _number(bound)
+                        lines.append(f"{full}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{full}_sum{_labels(labels)} {_number(total)}")
+                    lines.append(f"{full}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f"{key}=\"{value}\"")
+    return "{" + ",".join(pairs) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def queue_logger(name, stream=None):
+    """
+    Returns a logger that only puts its records in a queue, a background thread formats them and writes them,
+    so logging never blocks a request on the output.
+    :param name: The name of the logger
+    :param stream: Where the lines are written, sys.stdout if None
+    :return: A logging.Logger instance
+    """
+    logger = logging.getLogger(name)
+    if not any(isinstance(handler, logging.handlers.QueueHandler) for handler in logger.handlers):
+        records = queue.SimpleQueue()
+        output = logging.StreamHandler(sys.stdout if stream is None else stream)
+        # The same timestamps as time.asctime()
+        output.setFormatter(logging.Formatter("%(asctime)s %(message)s", "%a %b %d %H:%M:%S %Y"))
+        listener = logging.handlers.QueueListener(records, output)
+        listener.start()
+        # Pending lines are written when the process exits
+        atexit.register(listener.stop)
+        logger.addHandler(logging.handlers.QueueHandler(records))
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
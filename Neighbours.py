@@ -0,0 +1,70 @@
+import numpy as np
+
+# The ways of choosing the similar users of a query:
+# "radius" those within max_dist, completed with the k - (those within) closest ones, which come first among them
+# again, so there are k of them
+# "knn" the k closest ones, whatever their distance
+# "weighted" the same users as "radius", each weighted by distance_weights when aggregating their preferences
+MODES = ("radius", "knn", "weighted")
+
+
+def check_mode(mode):
+    """
+    Raises a ValueError if mode is not one of MODES.
+    :param mode: A string
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown neighbour mode {mode}")
+
+
+def top_k(distances, k):
+    """
+    Returns the positions of the k smallest distances, without sorting the whole array. Ties are broken by
+    position, so the result is the same that a stable sort would give, on any backend.
+    :param distances: A float array
+    :param k: The ammount of positions to return
+    :return: An array of positions, sorted by (distance, position)
+    """
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k >= len(distances):
+        return np.argsort(distances, kind="stable")
+    part = np.argpartition(distances, k - 1)[:k]
+    kth = distances[part].max()
+    # argpartition chooses arbitrarily among the distances equal to the k-th one, we take the first of them.
+    smaller = np.flatnonzero(distances < kth)
+    ties = np.flatnonzero(distances == kth)[:k - len(smaller)]
+    chosen = np.concatenate((smaller, ties))
+    return chosen[np.lexsort((chosen, distances[chosen]))]
+
+
+def select_neighbours(distances, max_dist, k, mode="radius"):
+    """
+    Chooses the similar users among some candidates given their distances with the query.
+    :param distances: A float array with the distance between the query and each candidate
+    :param max_dist: The maximum distance for similar users, not used by "knn"
+    :param k: The minimum ammount of similar users for "radius" and "weighted", the exact ammount for "knn"
+    :param mode: One of MODES
+    :return: An array of positions in distances. For "radius" and "weighted" those within max_dist come first
+    in their original order, followed by the closest others, as list_similar_users always returned them.
+    For "knn" they are sorted by distance.
+    """
+    check_mode(mode)
+    if mode == "knn":
+        return top_k(distances, k)
+    similar = np.flatnonzero(distances <= max_dist)
+    if len(similar) < k:
+        # The missing users are the closest among all the candidates, those within max_dist included, so these
+        # come again and count twice (the original list_similar_users took them from all the distances).
+        similar = np.concatenate((similar, top_k(distances, k - len(similar))))
+    return similar
+
+
+def distance_weights(distances):
+    """
+    The weight of each similar user in "weighted" mode, 1 / (1 + distance), so 1 for identical users and 0 for
+    users at infinite distance.
+    :param distances: A float array of distances
+    :return: A float array of weights
+    """
+    return 1.0 / (1.0 + np.asarray(distances, dtype=float))
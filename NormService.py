@@ -0,0 +1,126 @@
+from random import randint
+from User import CompactUser
+from Demographics import FIELDS
+
+# The ammount of answers of each of the 5 questions sent by /questions, in order
+ANSWERS_PER_QUESTION = (10, 5, 5, 6, 6)
+
+
+def questions_payload(catalogue):
+    """
+    Chooses the questions of /questions, a selection of question types that will give 32 data points.
+    :param catalogue: The QuestionCatalogue to draw them from
+    :return: A tuple (payload, uid), the dictionary sent as JSON and the uid identifying the questions
+    """
+    questions = ""
+    text_out = {}
+    prev = {}
+    for i, num_answers in enumerate(ANSWERS_PER_QUESTION):
+        # The second question of each kind is different from the first one
+        q_name, q_text = catalogue.sample(num_answers, prev.get(num_answers, "Q0"))
+        prev[num_answers] = q_name
+        questions += q_name + ';'
+        text_out[f"q{i}"] = q_text
+    text_out["uid"] = questions
+    return text_out, questions
+
+
+def read_user(questions, args, columns):
+    """
+    Builds the user of a /predict request from its parameters, the answers to the questions of the uid.
+    :param questions: The question names of the uid, e.g. ["Q12", "Q40", ...]
+    :param args: The mapping of request parameters, answer a of question q is f"q{q}_{a}"
+    :param columns: The columns to store the user by, e.g. the PrefMatrix of the database
+    :return: A CompactUser instance
+    """
+    user = CompactUser(columns)
+    for q, num_answers in enumerate(ANSWERS_PER_QUESTION):
+        for a in range(1, num_answers + 1):
+            user.add_pref(f"{questions[q]}_{a}", int(args[f"q{q}_{a}"]))
+    return user
+
+
+def read_answers(questions, args):
+    """
+    Same as read_user, returning the answers as a dictionary.
+    :param questions: The question names of the uid, e.g. ["Q12", "Q40", ...]
+    :param args: The mapping of request parameters, answer a of question q is f"q{q}_{a}"
+    :return: A dictionary {preference id: value}
+    """
+    return {f"{questions[q]}_{a}": int(args[f"q{q}_{a}"]) for q, num_answers in enumerate(ANSWERS_PER_QUESTION)
+            for a in range(1, num_answers + 1)}
+
+
+def profile_key(args):
+    """
+    Returns a key identifying the answer profile of a /predict request, two requests with the same uid and
+    answers have the same key.
+    :param args: The mapping of request parameters
+    :return: A hashable tuple
+    """
+    answers = tuple(args.get(f"q{q}_{a}") for q, num_answers in enumerate(ANSWERS_PER_QUESTION)
+                    for a in range(1, num_answers + 1))
+    demographics = tuple(args.get(name) for name in FIELDS)
+    return args.get("uid"), answers, demographics
+
+
+def predict_payload(pred, args, max_dist=0, min_common=5, min_users_pred=5, budget=0.1):
+    """
+    Makes the predictions of /predict. The steps are timed with the metrics of pred, if it has any.
+    :param pred: The PrefPredict instance to use for the whole request
+    :param args: The mapping of request parameters, the uid of /questions and the answers, optionally the
+    demographics of the user (e.g. spa_owner=yes&age=30, see Demographics.FIELDS) to look for similar users in
+    their segment first
+    :param max_dist: The maximum distance for similar users
+    :param min_common: The minimum ammount of common preferences
+    :param min_users_pred: The minimum ammount of similar users
+    :param budget: The seconds that can be spent scoring candidates, see PrefPredict.select_norms
+    :return: A tuple (payload, predict_out, control_out), the dictionary sent as JSON and the log lines of the
+    predictions and the controls
+    """
+    catalogue = pred.catalogue
+    questions = args['uid'].split(';')
+    text_out = {}
+    predict_out = f"{args['uid']}: "
+    control_out = f"{args['uid']}: "
+
+    with pred.span("user"):
+        user = read_user(questions, args, pred.matrix)
+        segment = pred.segments.segment(args) if pred.segments is not None else None
+
+    # make predictions: score the unknown preferences in batches and pick 3 of those with a norm at random,
+    # giving up on more candidates once the time budget is spent
+    chosen = pred.select_norms(user, 3, mode="sample", budget=budget, max_dist=max_dist, min_common=min_common,
+                               min_users_pred=min_users_pred, segment=segment)
+    with pred.span("render"):
+        for i, p in enumerate(chosen.itertuples()):
+            q_name = p.Index
+            q_text = catalogue.texts[q_name]
+            outcome = ["would not", "might", "would"][p.block-1]
+            predict_out += f"predict {q_name} as {outcome} with confidence {round(p.conf,2)}; "
+            text_out[f"p{i}"] = f"{q_text}.<br><br>We think that in this situation you <b>{outcome}</b> choose to share information as descibed above."
+            text_out[f"pname{i}"] = q_name
+            text_out[f"conf{i}"] = float(p.conf)
+
+        # choose controls
+        for i in range(3):
+            q_name, q_text = catalogue.random_preference()
+            outcome = ["would", "would not"][randint(0, 1)]
+            control_out += f"control {q_name} as {outcome}; "
+            text_out[f"c{i}"] = f"{q_text}.<br><br>We think that in this situation you <b>{outcome}</b> choose to share information as descibed above."
+
+    return text_out, predict_out, control_out
+
+
+def ingest_payload(engine, args):
+    """
+    Adds the respondent of an /ingest request to the database in use, see PredictEngine.ingest.
+    :param engine: The PredictEngine of the database
+    :param args: The mapping of request parameters, the same as those of /predict
+    :return: A tuple (payload, ingest_out), the dictionary sent as JSON and the log line
+    :raise ValueError: If some answer is not a preference in the scale 1-5
+    """
+    answers = read_answers(args['uid'].split(';'), args)
+    demographics = {name: args[name] for name in FIELDS if args.get(name)}
+    user_id = engine.ingest(answers, demographics)
+    return {"user_id": user_id}, f"{args['uid']}: ingested as user {user_id}"
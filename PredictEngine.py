@@ -0,0 +1,248 @@
+import os
+import threading
+import time as t
+from PrefPredict import PrefPredict
+from PrefCache import PairCache, ResultCache
+from Metrics import Metrics, queue_logger
+from DataLoader import IngestLog, cache_prefix, load_dataset, log_path
+from Demographics import SegmentIndex
+from ClusterIndex import ClusterIndex
+
+
+class PredictEngine:
+
+    def __init__(self, path="main_data.csv", max_dist=0, min_common=5, min_users_pred=5, check_interval=5.0,
+                 backend="matrix", metrics=None, cache_results=False, result_cache_path=None, demographics_path=None,
+                 segment_by=("spa_owner", "age_band"), compact_every=100, approx_clusters=None, approx_probe=8):
+        """
+        Keeps a single PrefPredict instance alive for the whole process, so the database is only loaded once
+        and not on every request. The instance is shared between threads: callers take a snapshot with
+        current() and keep using it until they are done, even if the database is reloaded in the meantime.
+        :param path: The path of the privacy preferences database
+        :param max_dist: The default maximum distance between two users for them to be considered similar
+        :param min_common: The default minimum ammount of commonly known preferences
+        :param min_users_pred: The default minimum ammount of similar users required to make a prediction
+        :param check_interval: Seconds between two checks of the database file for changes, None to never reload
+        :param backend: The PrefPredict backend, see PrefPredict
+        :param metrics: The Metrics instance shared by every loaded PrefPredict, a new one if None
+        :param cache_results: True to cache the predictions (see PrefCache.ResultCache), they are always computed
+        by default. Most requests come with new answers, so the cache rarely helps.
+        :param result_cache_path: The sqlite file of the disk tier of the prediction cache, None to only cache
+        predictions in memory. Caching to disk implies cache_results
+        :param demographics_path: The path of demographics.csv, to search the similar users of queries with
+        demographics in their segment first (see Demographics.SegmentIndex), None to always search everybody
+        :param segment_by: The segmenters the users are partitioned by, see Demographics.SEGMENTERS
+        :param compact_every: The ammount of users ingested by this process after which the ingestion log is
+        compacted into the binary cache of the database, see compact
+        :param approx_clusters: The ammount of clusters of an approximate search of similar users (see
+        ClusterIndex), None for the exact search
+        :param approx_probe: The ammount of clusters compared with each query in the approximate search, more
+        give a better recall and a slower search
+        """
+        self.path = path
+        self.max_dist = max_dist
+        self.min_common = min_common
+        self.min_users_pred = min_users_pred
+        self.check_interval = check_interval
+        self.backend = backend
+        self.demographics_path = demographics_path
+        self.segment_by = tuple(segment_by)
+        # The pairs are keyed by the preferences of the users, so the cache stays valid across reloads.
+        self.pair_cache = PairCache()
+        # The predictions are tied to the version of the dataset, a reload with new content drops them.
+        self.result_cache = None
+        if cache_results or result_cache_path is not None:
+            self.result_cache = ResultCache(path=result_cache_path)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.counter("reloads_total", "Reloads of the database, by outcome.")
+        self.metrics.gauge("pair_cache", "Counters of the cache of pairs of users.",
+                           lambda: self.cache_stats(self.pair_cache))
+        self.metrics.gauge("result_cache", "Counters of the cache of predictions.",
+                           lambda: self.cache_stats(self.result_cache))
+        self.metrics.counter("ingested_total", "Users appended from the ingestion log.")
+        # The respondents added while the database is in use, see ingest.
+        self.log = IngestLog(log_path(path))
+        self.compact_every = compact_every
+        self.approx_clusters = approx_clusters
+        self.approx_probe = approx_probe
+        self._uncompacted = 0
+        # Only one reload can run at a time, requests never wait for this lock.
+        self._reload_lock = threading.Lock()
+        # Appending users to the current instance and replacing it are done one at a time, both are quick.
+        self._swap_lock = threading.Lock()
+        self._last_check = t.monotonic()
+        self._mtime = os.stat(path).st_mtime
+        self._pred = self._catch_up(self.load())[0]
+
+    def load(self):
+        """
+        Loads the database (from its binary cache when it is up to date) and builds a new PrefPredict
+        instance from it.
+        :return: A PrefPredict instance
+        """
+        dataset = load_dataset(self.path)
+        if dataset.log_offset and self.log.checksum(dataset.log_offset) != dataset.log_check:
+            # The cache was compacted from a log that changed since (e.g. it was merged into the csv and removed)
+            dataset = load_dataset(self.path, cache=False)
+        segments = None
+        if self.demographics_path is not None:
+            segments = SegmentIndex.from_csv(self.demographics_path, dataset.user_ids, self.segment_by,
+                                             dataset.demographics, dataset.participants)
+        approx = None
+        if self.approx_clusters:
+            approx = ClusterIndex.build(dataset.values, self.approx_clusters, self.approx_probe)
+        return PrefPredict(self.max_dist, self.min_common, self.min_users_pred, path=self.path,
+                           backend=self.backend, pair_cache=self.pair_cache, dataset=dataset, metrics=self.metrics,
+                           result_cache=self.result_cache, segments=segments, approx=approx)
+
+    def current(self):
+        """
+        Returns the PrefPredict instance to use for a request. If the database file changed since it was
+        loaded, a reload is started in the background and the previous instance is returned meanwhile.
+        :return: A PrefPredict instance
+        """
+        if self.check_interval is not None and t.monotonic() - self._last_check >= self.check_interval:
+            self._last_check = t.monotonic()
+            self.check_reload()
+            self.check_log()
+        return self._pred
+
+    def ingest(self, answers, demographics=None):
+        """
+        Adds a respondent to the database in use: they are written to the ingestion log and appended to the
+        current instance, without reloading it. The other processes using the database append them when they
+        next check the log. Every compact_every users the log is compacted.
+        :param answers: A dictionary {preference id: value in the scale 1-5}
+        :param demographics: A dictionary with the demographics of the respondent (see Demographics.FIELDS), None
+        if unknown
+        :return: The user id given to the respondent
+        :raise ValueError: If a preference id is unknown or a value is not in the scale 1-5
+        """
+        pref_index = self._pred.matrix.pref_index
+        for p_id, val in answers.items():
+            if p_id not in pref_index:
+                raise ValueError(f"Unknown preference {p_id}")
+            if val not in (1, 2, 3, 4, 5):
+                raise ValueError(f"The value of {p_id} is not in the scale 1-5: {val}")
+        record = {"answers": {p_id: int(val) for p_id, val in answers.items()}, "demographics": demographics or {}}
+        with self._swap_lock:
+            end = self.log.append(record)
+            self._pred, ids = self._catch_up(self._pred)
+            self._uncompacted += len(ids)
+            compact = self._uncompacted >= self.compact_every
+        if compact:
+            self.compact()
+        return ids[end]
+
+    def check_log(self):
+        """
+        Appends to the current instance the users written to the ingestion log since, e.g. by other processes.
+        :return: A boolean, True if the log had new users
+        """
+        if self.log.size() <= self._pred.dataset.log_offset:
+            return False
+        with self._swap_lock:
+            self._pred, ids = self._catch_up(self._pred)
+        return len(ids) > 0
+
+    def compact(self):
+        """
+        Writes the users of the current instance, those of the csv and of the ingestion log, in the binary cache
+        of the database. Loading it then only reads the lines of the log written since.
+        """
+        with self._swap_lock:
+            dataset = self._pred.dataset
+            self._uncompacted = 0
+        dataset.log_check = self.log.checksum(dataset.log_offset)
+        try:
+            dataset.save(cache_prefix(self.path, dataset.version))
+        except OSError:
+            # The cache is only an optimization, the log still has every user.
+            pass
+
+    def _catch_up(self, pred):
+        # The users of the log after those of pred, and the id given to each of them by the offset of its end
+        entries, offset = self.log.read(pred.dataset.log_offset)
+        if offset == pred.dataset.log_offset:
+            return pred, {}
+        records = [record for end, record in entries]
+        new = pred.appended([record.get("answers", {}) for record in records],
+                            [record.get("demographics") for record in records], offset)
+        self.metrics.inc("ingested_total", len(records))
+        return new, {end: u_id for (end, record), u_id in zip(entries, new.user_ids[len(pred.user_ids):])}
+
+    @staticmethod
+    def cache_stats(cache):
+        """
+        The counters of a cache (hits, misses, evictions...) as labelled gauge values, see Metrics.gauge. There
+        are none if the cache is not used (None).
+        """
+        if cache is None:
+            return {}
+        return {(("stat", name),): value for name, value in cache.stats().items()}
+
+    @property
+    def data(self):
+        """
+        The DataFrame of the database currently in use, it is shared by everything using the current instance.
+        """
+        return self._pred.data
+
+    def check_reload(self):
+        """
+        Starts a background reload if the database file changed and no other reload is running.
+        :return: A boolean, True if a reload was started
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            # The file may be in the middle of being replaced, we keep the current instance.
+            return False
+        if mtime == self._mtime or not self._reload_lock.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._reload, args=(mtime,), daemon=True).start()
+        return True
+
+    def reload(self):
+        """
+        Reloads the database synchronously, regardless of the modification time of the file.
+        """
+        with self._reload_lock:
+            self._swap(os.stat(self.path).st_mtime)
+
+    def _reload(self, mtime):
+        try:
+            self._swap(mtime)
+            self.metrics.inc("reloads_total", outcome="success")
+        except Exception as e:
+            # A file that is still being written can fail to parse, we retry on the next check.
+            self.metrics.inc("reloads_total", outcome="failure")
+            queue_logger("norm_prediction").warning(f"reload of {self.path} failed: {e}")
+        finally:
+            self._reload_lock.release()
+
+    def _swap(self, mtime):
+        pred = self.load()
+        with self._swap_lock:
+            # Users may have been ingested while it was loading
+            pred = self._catch_up(pred)[0]
+            # Replacing the reference is atomic, requests holding the old instance finish with it.
+            self._pred = pred
+            self._mtime = mtime
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(path="main_data.csv", **kwargs):
+    """
+    Returns the engine of this process for the given database, creating it the first time.
+    :param path: The path of the privacy preferences database
+    :param kwargs: Arguments for PredictEngine, only used when the engine is created
+    :return: A PredictEngine instance
+    """
+    with _engines_lock:
+        if path not in _engines:
+            _engines[path] = PredictEngine(path, **kwargs)
+        return _engines[path]
@@ -0,0 +1,336 @@
+import atexit
+import hashlib
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time as t
+from collections import OrderedDict
+import numpy as np
+
+# Rough memory used by the bookkeeping of an entry (ordered dict node, expiry time, size), in bytes.
+ENTRY_OVERHEAD = 120
+# Rough memory used by the key of the predictions of a request (a 16 bytes digest), or by an array without its data
+RESULT_SIZE = 112
+# Tells a missing entry apart from a cached None
+_MISSING = object()
+
+
+def approx_size(obj):
+    """
+    Estimates the memory held by a cached key or value. Containers are followed, strings inside them are not
+    counted because they are shared with the users (e.g. preference ids).
+    :param obj: The object to measure
+    :return: An integer, the ammount of bytes
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum(approx_size(o) for o in obj if not isinstance(o, str))
+    return size
+
+
+def result_size(obj):
+    """
+    Estimates the memory held by a key or a value of a ResultCache, without measuring their content.
+    :param obj: A bytes digest or a float array
+    :return: An integer, the ammount of bytes
+    """
+    return RESULT_SIZE + (obj.nbytes if isinstance(obj, np.ndarray) else 0)
+
+
+class LRUCache:
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None, sizeof=approx_size):
+        """
+        A thread safe cache evicting the least recently used entries when it is over budget, entries can also
+        expire after some time. It counts hits, misses, evictions and expirations so it can be sized against
+        real traffic.
+        :param max_entries: The maximum ammount of entries, None for no limit
+        :param max_bytes: The memory budget in bytes, as estimated by sizeof, None for no limit
+        :param ttl: The seconds an entry lives after being stored, None for no expiration
+        :param sizeof: A function estimating the bytes of a key or a value
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        # key -> (value, expiry time, size), the least recently used entry first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for key and marks it as recently used.
+        :param key: A hashable key
+        :param default: The value returned when the key is not cached (or expired)
+        :return: The cached value or default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= t.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Stores value for key, evicting the least recently used entries if the cache goes over budget.
+        :param key: A hashable key
+        :param value: The value to store
+        """
+        size = self.sizeof(key) + self.sizeof(value) + ENTRY_OVERHEAD
+        expiry = None if self.ttl is None else t.monotonic() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expiry, size)
+            self._bytes += size
+            while self._entries and self._over_budget():
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _over_budget(self):
+        return (self.max_entries is not None and len(self._entries) > self.max_entries) or \
+               (self.max_bytes is not None and self._bytes > self.max_bytes)
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[2]
+
+    def clear(self):
+        """
+        Removes every entry, the counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+        :return: A dictionary with the hits, misses, evictions, expirations, entries and (estimated) bytes
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "expirations": self.expirations, "entries": len(self._entries), "bytes": self._bytes}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class PairCache(LRUCache):
+
+    def __init__(self, max_entries=None, max_bytes=64 * 2 ** 20, ttl=None):
+        """
+        Caches, for pairs of users, their commonly known preferences and the sum of the differences between them.
+        Users are identified by the fingerprint of their known preferences, so users with identical answers
+        share entries and a User instance that is discarded does not keep its entries alive forever.
+        :param max_entries: The maximum ammount of pairs, None for no limit
+        :param max_bytes: The memory budget in bytes, None for no limit
+        :param ttl: The seconds a pair lives after being stored, None for no expiration
+        """
+        LRUCache.__init__(self, max_entries, max_bytes, ttl)
+
+    @staticmethod
+    def pair_key(user1, user2):
+        """
+        Returns the key of a pair of users, it does not depend on their order.
+        :param user1: A User instance
+        :param user2: A User instance
+        :return: A tuple of two fingerprints
+        """
+        fp1 = user1.fingerprint()
+        fp2 = user2.fingerprint()
+        return (fp1, fp2) if fp1 <= fp2 else (fp2, fp1)
+
+
+class ResultCache(LRUCache):
+
+    def __init__(self, max_entries=None, max_bytes=32 * 2 ** 20, ttl=None, path=None, max_disk_entries=10 ** 4):
+        """
+        Caches predictions, keyed by result_key: an entry holds all the predictions of a request (e.g. those of
+        a predict_many call), so a request reads and writes a single entry. Entries live in memory and, if a
+        path is given, also in a sqlite database, so they survive restarts and are shared by the processes
+        using the same file. The disk writes are made by a background thread, never by the requests.
+        Keys include the version of the dataset and set_version drops the entries of other versions.
+        :param max_entries: The maximum ammount of entries in memory, None for no limit
+        :param max_bytes: The memory budget in bytes, None for no limit
+        :param ttl: The seconds an entry lives in memory after being stored, None for no expiration
+        :param path: The path of the sqlite database of the disk tier, None to only keep them in memory
+        :param max_disk_entries: The maximum ammount of entries on disk, the oldest are removed first
+        """
+        LRUCache.__init__(self, max_entries, max_bytes, ttl, sizeof=result_size)
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.version = None
+        self.disk_hits = 0
+        # The connection of each thread (and process), see _execute
+        self._local = threading.local()
+        self._pending = None
+        self._writer_pid = None
+        self._writer_lock = threading.Lock()
+        self._disk_writes = 0
+
+    @staticmethod
+    def result_key(fingerprint, pref_ids, max_dist, min_common, min_users_pred, rho, mu, neighbour_mode, version,
+                   segment=None, counts=None, approx=None):
+        """
+        Returns the key of the predictions of some preferences of a user, a hash of everything they depend on.
+        Numbers are normalized, so e.g. max_dist 0 and 0.0 give the same key.
+        :param fingerprint: The fingerprint of the known preferences of the user, see User.fingerprint
+        :param pref_ids: A list with the ids of the predicted preferences
+        :param max_dist: The maximum distance for similar users
+        :param min_common: The minimum ammount of common preferences
+        :param min_users_pred: The minimum ammount of similar users
+        :param rho: The confidence weight of the distance
+        :param mu: The confidence weight of the standard deviation
+        :param neighbour_mode: One of Neighbours.MODES
+        :param version: The version of the dataset, see DataLoader.Dataset
+        :param segment: The demographic segment the similar users were searched in first, None if none
+        :param counts: The ammount of database users that answered each preference, so the key changes when
+        users answering some of them are appended to the dataset, None if the dataset never grows
+        :param approx: A description of the approximate search of similar users (see ClusterIndex.key), None
+        for the exact search
+        :return: A bytes digest
+        """
+        settings = (fingerprint, float(max_dist), int(min_common), int(min_users_pred), float(rho), float(mu),
+                    neighbour_mode, version, segment, approx)
+        digest = hashlib.blake2b(repr(settings).encode(), digest_size=16)
+        digest.update("\n".join(pref_ids).encode())
+        if counts is not None:
+            digest.update(np.asarray(counts, dtype=np.int64).tobytes())
+        return digest.digest()
+
+    def set_version(self, version):
+        """
+        Sets the version of the dataset the predictions are made with. When it changes, the predictions of
+        the previous versions are removed, from memory and from disk.
+        :param version: The version of the dataset, see DataLoader.Dataset
+        """
+        if version == self.version:
+            return
+        self.version = version
+        self.clear()
+        self._execute("DELETE FROM results WHERE version != ?", (version,))
+
+    def get(self, key, default=None):
+        """
+        Returns the predictions stored for key, from memory or else from disk.
+        :param key: A key returned by result_key
+        :param default: The value returned when the key is not cached
+        :return: The cached value or default
+        """
+        value = LRUCache.get(self, key, _MISSING)
+        if value is not _MISSING:
+            return value
+        rows = self._execute("SELECT value FROM results WHERE key = ?", (key,))
+        if not rows:
+            return default
+        value = np.frombuffer(rows[0][0], dtype=float).reshape(-1, 3)
+        self.disk_hits += 1
+        LRUCache.put(self, key, value)
+        return value
+
+    def put(self, key, value, version=None):
+        """
+        Stores predictions in memory, and queues them to be written on disk.
+        :param key: A key returned by result_key
+        :param value: A float array with a row (prediction, confidence, ammount of similar users) per
+        prediction, it must not be modified afterwards
+        :param version: The version of the dataset the predictions were made with, self.version if None. It
+        differs when an instance using an older dataset finishes its predictions after a reload, they are then
+        removed with those of its version.
+        """
+        if version is None:
+            version = self.version
+        LRUCache.put(self, key, value)
+        if self.path is not None:
+            self._write_later((key, version, np.ascontiguousarray(value, dtype=float).tobytes(), t.time()))
+
+    def flush(self):
+        """
+        Waits until the entries queued by this process are written on disk.
+        """
+        if self._pending is not None and self._writer_pid == os.getpid():
+            self._pending.join()
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+        :return: The dictionary of LRUCache.stats, with the ammount of hits served from disk
+        """
+        stats = LRUCache.stats(self)
+        stats["disk_hits"] = self.disk_hits
+        return stats
+
+    def _write_later(self, row):
+        with self._writer_lock:
+            if self._writer_pid != os.getpid():
+                # A thread does not survive a fork, each process starts its own writer.
+                self._pending = queue.Queue()
+                self._writer_pid = os.getpid()
+                threading.Thread(target=self._write_pending, args=(self._pending,), daemon=True).start()
+                # Entries still queued when the process exits are written
+                atexit.register(self.flush)
+        self._pending.put(row)
+
+    def _write_pending(self, pending):
+        while True:
+            rows = [pending.get()]
+            # Everything queued meanwhile is written in the same transaction
+            while True:
+                try:
+                    rows.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            self._execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", rows, many=True)
+            self._disk_writes += len(rows)
+            if self._disk_writes >= 256:
+                self._disk_writes = 0
+                # The stored column is indexed, the oldest entries are found without reading the others
+                self._execute("DELETE FROM results WHERE stored < (SELECT stored FROM results ORDER BY stored DESC "
+                              "LIMIT 1 OFFSET ?)", (self.max_disk_entries,))
+            for _ in rows:
+                pending.task_done()
+
+    def _execute(self, sql, params, many=False):
+        # The disk tier is only an optimization, if the database is busy or broken we go on without it.
+        if self.path is None:
+            return []
+        try:
+            db = getattr(self._local, "db", None)
+            if db is None or self._local.pid != os.getpid():
+                # A connection can only be used by the thread that opened it, and not by a forked process. The
+                # writer has its own, so reading an entry never waits for a write.
+                db = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+                self._local.db = db
+                self._local.pid = os.getpid()
+                db.execute("PRAGMA journal_mode=WAL")
+                # Losing the last entries in a power failure is fine for a cache, commits do not wait for the disk
+                db.execute("PRAGMA synchronous=NORMAL")
+                db.execute("CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, version TEXT, value BLOB, "
+                           "stored REAL)")
+                db.execute("CREATE INDEX IF NOT EXISTS results_stored ON results(stored)")
+            if many:
+                db.execute("BEGIN")
+                try:
+                    db.executemany(sql, params)
+                    db.execute("COMMIT")
+                except sqlite3.Error:
+                    db.execute("ROLLBACK")
+                    raise
+                return []
+            return db.execute(sql, params).fetchall()
+        except sqlite3.Error:
+            return []
@@ -0,0 +1,349 @@
+import copy
+import math
+import numpy as np
+from Neighbours import distance_weights
+from User import CompactUser
+
+
+class PrefMatrix:
+
+    def __init__(self, values, preference_ids):
+        """
+        Stores the preferences of the database users as a dense users x preferences array, so the distance
+        between a user and every database user can be computed at once.
+        :param values: An int8 array with one row per database user and one column per preference, holding the
+        preference in the scale 1-5, or 0 when the preference is unknown
+        :param preference_ids: A list with the preference id of each column
+        """
+        self.values = values
+        # The validity mask, True where the preference of the database user is known.
+        self.known = values > 0
+        self.preference_ids = list(preference_ids)
+        self.pref_index = {p_id: col for col, p_id in enumerate(self.preference_ids)}
+        # The arrays rows are appended to (see appended), values and known are their first rows. They are
+        # shared by the matrices appended from this one, which only write after the rows the others see.
+        self._values_buffer = values
+        self._known_buffer = self.known
+        self._appended_rows = {"rows": len(values)}
+        self.build_index()
+
+    def build_index(self):
+        """
+        Builds the inverted index of the matrix: for every preference, the rows of the database users that
+        answered it, how many they are and how many gave each of the answers 1-5.
+        """
+        # The known cells ordered by column and then by row, so each column is a contiguous block.
+        cols, rows = np.nonzero(self.known.T)
+        rows = rows.astype(np.int32)
+        rows.flags.writeable = False
+        self.answer_counts = np.bincount(cols, minlength=len(self.preference_ids))
+        bounds = np.concatenate(([0], np.cumsum(self.answer_counts)))
+        # These are read-only views of a single array, in database order.
+        self.pref_rows = [rows[bounds[col]:bounds[col + 1]] for col in range(len(self.preference_ids))]
+        # The arrays the rows of each column are appended to, the same views until something is appended
+        self._rows_buffers = list(self.pref_rows)
+        # histograms[col, v - 1] is the ammount of users that answered v to the preference of column col.
+        self.histograms = np.stack([(self.values == v).sum(axis=0) for v in range(1, 6)], axis=1)
+
+    def appended(self, values):
+        """
+        Returns a matrix with the rows of this one followed by some new database users. This matrix is not
+        modified, so it can still be used by whoever holds it. The arrays are shared and grown by doubling,
+        so the cost is proportional to the new answers (amortized), not to the size of the database.
+        :param values: An int8 array with one row per new user and one column per preference, in the scale 1-5
+        and 0 when unknown
+        :return: A PrefMatrix instance
+        """
+        values = np.asarray(values, dtype=np.int8).reshape(-1, len(self.preference_ids))
+        start = self.num_users()
+        end = start + len(values)
+        # Only the last matrix appended to writes in the shared arrays, appending again to an older one copies
+        owner = self._appended_rows["rows"] == start
+        new = copy.copy(self)
+        new._values_buffer = append_rows(self._values_buffer, start, values, owner)
+        new._known_buffer = append_rows(self._known_buffer, start, values > 0, owner)
+        new.values = new._values_buffer[:end]
+        new.known = new._known_buffer[:end]
+        new.answer_counts = self.answer_counts.copy()
+        new.histograms = self.histograms.copy()
+        new.pref_rows = list(self.pref_rows)
+        new._rows_buffers = list(self._rows_buffers)
+        new_rows, cols = np.nonzero(values > 0)
+        np.add.at(new.histograms, (cols, values[new_rows, cols] - 1), 1)
+        # The known cells grouped by column, rows stay in database order
+        by_col = np.argsort(cols, kind="stable")
+        new_rows, cols = new_rows[by_col] + start, cols[by_col]
+        for col, first, last in _runs(cols):
+            count = new.answer_counts[col]
+            buffer = append_rows(new._rows_buffers[col], count, new_rows[first:last].astype(np.int32), owner)
+            view = buffer[:count + last - first]
+            view.flags.writeable = False
+            new._rows_buffers[col] = buffer
+            new.pref_rows[col] = view
+            new.answer_counts[col] += last - first
+        if owner:
+            self._appended_rows["rows"] = end
+        else:
+            new._appended_rows = {"rows": end}
+        return new
+
+    def num_users(self):
+        """
+        Returns the ammount of database users, i.e. the rows of the matrix.
+        :return: An integer
+        """
+        return self.values.shape[0]
+
+    def encode(self, user):
+        """
+        Transforms the known preferences of a User instance into the columns of the matrix.
+        :param user: A User instance
+        :return: A tuple (cols, vals) of arrays, the columns of the known preferences and their values
+        """
+        if isinstance(user, CompactUser) and user.columns.pref_index is self.pref_index and not user.extra:
+            # The user is already stored by the columns of this matrix
+            return user.known_cols()
+        cols = []
+        vals = []
+        for p_id in user.known_pref_fields():
+            col = self.pref_index.get(p_id)
+            val = user.get_pref(p_id)
+            if col is not None and not math.isnan(val):
+                cols.append(col)
+                vals.append(val)
+        return np.array(cols, dtype=np.intp), np.array(vals, dtype=np.int16)
+
+    def encode_row(self, row):
+        """
+        Same as encode, for a database user given by its row.
+        :param row: The row of the database user
+        :return: A tuple (cols, vals) of arrays, the columns of the known preferences and their values
+        """
+        cols = np.flatnonzero(self.values[row] > 0)
+        return cols, self.values[row, cols].astype(np.int16)
+
+    def valid_rows(self, pref_id):
+        """
+        Returns the rows of the database users for which we know their preference for pref_id.
+        :param pref_id: A string id of the preference
+        :return: An array of row indices, in database order
+        """
+        return self.pref_rows[self.pref_index[pref_id]]
+
+    def rows_for_any(self, cols, among=None, block=4096):
+        """
+        Returns the rows of the database users that know at least one of the given preferences.
+        :param cols: An array with the columns of the preferences
+        :param among: A boolean mask of the rows to look at, e.g. those of a segment, or None for all of them
+        :param block: The ammount of rows read at once when only those of among are read
+        :return: An array of row indices, in database order
+        """
+        if among is not None:
+            rows = np.flatnonzero(among)
+            # When they are few, reading the given columns of those rows is quicker than the union of the rows of
+            # each preference, which follows the ammount of answers in the whole database (marking an answer takes
+            # about twice as long as reading a cell).
+            if len(rows) * len(cols) < 2 * sum(len(self.pref_rows[col]) for col in cols):
+                hit = [take_cells(self.known, rows[start:start + block], cols).any(axis=1)
+                       for start in range(0, len(rows), block)]
+                return rows[np.concatenate(hit)] if hit else rows
+        if len(cols) == 1:
+            rows = self.pref_rows[cols[0]]
+        else:
+            # The union of the rows of each preference. Marking them in a mask only reads their answers, not the
+            # columns of every user, and is quicker than sorting them together.
+            hit = np.zeros(self.num_users(), dtype=bool)
+            for col in cols:
+                hit[self.pref_rows[col]] = True
+            rows = np.flatnonzero(hit)
+        return rows if among is None else rows[among[rows]]
+
+    def count_known(self, rows, block=4096):
+        """
+        Counts, for every preference, the users among some rows that know it.
+        :param rows: An array of rows
+        :param block: The ammount of rows read at once, it bounds the memory used
+        :return: An integer array with one entry per preference
+        """
+        counts = np.zeros(len(self.preference_ids), dtype=np.int64)
+        for start in range(0, len(rows), block):
+            counts += self.known[rows[start:start + block]].sum(axis=0, dtype=np.int32)
+        return counts
+
+    def distance_parts(self, cols, vals, rows=None):
+        """
+        Computes, for every database user, the sum of the absolute differences over the preferences known
+        for both them and the query, and the ammount of those commonly known preferences.
+        :param cols: An array with the columns known for the query, as returned by encode
+        :param vals: An array with the values of the query for those columns
+        :param rows: An array of rows to restrict the computation to, or None for all database users
+        :return: A tuple (sums, common) of integer arrays, one entry per row
+        """
+        if rows is None:
+            sub = self.values[:, cols]
+        else:
+            sub = take_cells(self.values, rows, cols)
+        common_mask = sub > 0
+        diff = np.abs(sub.astype(np.int16) - vals)
+        sums = np.where(common_mask, diff, 0).sum(axis=1, dtype=np.int64)
+        common = common_mask.sum(axis=1, dtype=np.int64)
+        return sums, common
+
+    def distances(self, cols, vals, min_common, rows=None):
+        """
+        Vectorized version of PrefPredict.distance between a query and every database user. Each distance is
+        the average difference between the commonly known preferences, or infinity when there are less than
+        min_common of them. The results are the same floats distance returns.
+        :param cols: An array with the columns known for the query, as returned by encode
+        :param vals: An array with the values of the query for those columns
+        :param min_common: The minimum ammount of commonly known preferences
+        :param rows: An array of rows to restrict the computation to, or None for all database users
+        :return: A float array with one distance per row
+        """
+        sums, common = self.distance_parts(cols, vals, rows)
+        return parts_to_distances(sums, common, min_common)
+
+    def rank(self, distances, rows=None):
+        """
+        Sorts the users by distance with a query, ties in database order, as neighbour_stats does.
+        :param distances: A float array with the distance between the query and every database user, or with
+        the users of rows
+        :param rows: The rows distances refers to, or None for all users
+        :return: A tuple (order, sorted_dis) of arrays, the rows of the users from the closest one and their
+        distances
+        """
+        order = np.argsort(distances, kind="stable")
+        sorted_dis = distances[order]
+        if rows is not None:
+            order = rows[order]
+        return order, sorted_dis
+
+    def neighbour_stats(self, distances, targets, max_dist, min_users_pred, rows=None, mode="radius", chunk=256,
+                        ranking=None):
+        """
+        Aggregates the preferences of the similar users of a query for many targeted preferences at once.
+        For each target the similar users are chosen as Neighbours.select_neighbours does among the users that
+        know the target, e.g. in "radius" mode those within max_dist, completed with the closest ones (those within
+        max_dist again first) until there are min_users_pred of them. Users chosen twice count twice.
+        :param distances: A float array with the distance between the query and every database user, or with
+        the users of rows
+        :param targets: An array with the columns of the targeted preferences
+        :param max_dist: The maximum distance for similar users
+        :param min_users_pred: The minimum ammount of similar users
+        :param rows: The rows distances refers to, e.g. those returned by rows_for_any, or None for all users
+        :param mode: One of Neighbours.MODES
+        :param chunk: The ammount of targets processed together, it bounds the memory used
+        :param ranking: The tuple returned by rank for the distances, to sort them a single time for many calls
+        with the same query. If given, distances and rows are not used.
+        :return: A tuple (count, mean, std, mean_dis) of arrays with one entry per target: the ammount of
+        similar users, the average and standard deviation of their preferences and their average distance
+        """
+        # Sorting once by distance (ties in database order) puts, for every target, its similar users first.
+        if ranking is None:
+            ranking = self.rank(distances, rows)
+        order, sorted_dis = ranking
+        # Those within max_dist are a prefix of the sorted users.
+        num_within = int(np.count_nonzero(sorted_dis <= max_dist))
+        results = [np.empty(len(targets)) for i in range(4)]
+        for start in range(0, len(targets), chunk):
+            cols = targets[start:start + chunk]
+            # Only the rows of the sorted users are read, not the columns of the whole matrix, so the cost
+            # follows the ammount of candidates (e.g. those of a segment or of the probed clusters).
+            if mode == "knn":
+                wanted = np.full(len(cols), min_users_pred)
+            else:
+                wanted = np.maximum(take_cells(self.known, order[:num_within], cols).sum(axis=0), min_users_pred)
+            # Usually only the first users are needed, we look at a growing prefix until every target has its
+            # similar users (or we run out of users).
+            end = min(len(order), num_within + 8 * min_users_pred)
+            while True:
+                valid = take_cells(self.known, order[:end], cols)
+                if end == len(order) or (valid.sum(axis=0) >= wanted).all():
+                    break
+                end = min(len(order), max(2 * end, 1))
+            # The rank of each valid user among those of its target, from 1
+            rank = np.cumsum(valid, axis=0, dtype=np.int32)
+            if mode == "knn":
+                take = (valid & (rank <= min_users_pred)).astype(np.int32)
+            else:
+                # Those within max_dist, plus the closest valid ones until there are min_users_pred, which
+                # start again from those within max_dist (see Neighbours.select_neighbours): they count twice.
+                missing = np.maximum(min_users_pred - valid[:num_within].sum(axis=0), 0)
+                take = (valid & (np.arange(end) < num_within)[:, None]).astype(np.int32) + (valid & (rank <= missing))
+            vals = take_cells(self.values, order[:end], cols)
+            dis = sorted_dis[:end, None]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                count = take.sum(axis=0)
+                mean_dis = np.where(take > 0, take * dis, 0.0).sum(axis=0) / count
+                if mode == "weighted":
+                    weights = np.where(take > 0, take * distance_weights(dis), 0.0)
+                    # When all the similar users are infinitely far, they all count the same.
+                    infinite = weights.sum(axis=0) == 0
+                    weights[:, infinite] = take[:, infinite]
+                    total = weights.sum(axis=0)
+                    mean = (weights * vals).sum(axis=0) / total
+                    var = (weights * (vals - mean) ** 2).sum(axis=0) / total
+                else:
+                    mean = (take * vals).sum(axis=0) / count
+                    var = np.where(take > 0, take * (vals - mean) ** 2, 0.0).sum(axis=0) / count
+            for res, part in zip(results, (count, mean, np.sqrt(var), mean_dis)):
+                res[start:start + chunk] = part
+        return tuple(results)
+
+
+def parts_to_distances(sums, common, min_common):
+    """
+    Turns the sums and common counts returned by PrefMatrix.distance_parts into distances.
+    :param sums: An integer array with the sum of absolute differences per row
+    :param common: An integer array with the ammount of commonly known preferences per row
+    :param min_common: The minimum ammount of commonly known preferences
+    :return: A float array of distances, math.inf where there are not enough common preferences
+    """
+    dis = np.full(len(common), math.inf)
+    valid = (common >= min_common) & (common > 0)
+    # Dividing two integers gives the correctly rounded float, exactly as sum / float(numcommon) does.
+    dis[valid] = sums[valid] / common[valid]
+    return dis
+
+
+def take_cells(array, rows, cols):
+    """
+    Returns the cells of some rows and columns of a matrix, as array[np.ix_(rows, cols)] does (with the same
+    memory layout, so sums over them give the same floats). Unless there are few columns, copying the rows
+    (contiguous in memory) and then taking the columns is quicker.
+    :param array: A 2D array, e.g. PrefMatrix.values or known
+    :param rows: An array of rows
+    :param cols: An array of columns
+    :return: A 2D array with a row per entry of rows and a column per entry of cols
+    """
+    if 8 * len(cols) < array.shape[1]:
+        return array[np.ix_(rows, cols)]
+    return np.take(array[rows], cols, axis=1)
+
+
+def append_rows(buffer, used, rows, owner=True):
+    """
+    Writes some rows after the first used rows of a buffer, in place if it has room for them, otherwise in a
+    new buffer of (at least) twice the size.
+    :param buffer: An array whose first used rows are in use
+    :param used: The ammount of rows in use
+    :param rows: An array with the rows to write
+    :param owner: A boolean, False if others may use the rows after used, then the buffer is always copied
+    :return: The buffer holding the rows, buffer itself or a new array
+    """
+    needed = used + len(rows)
+    if not owner or needed > len(buffer) or not buffer.flags.writeable:
+        bigger = np.zeros((max(needed, 2 * used, 8),) + buffer.shape[1:], dtype=buffer.dtype)
+        bigger[:used] = buffer[:used]
+        buffer = bigger
+    buffer[used:needed] = rows
+    return buffer
+
+
+def _runs(values):
+    # The (value, start, end) of each run of equal values of a sorted array
+    if len(values) == 0:
+        return []
+    starts = np.flatnonzero(np.diff(values)) + 1
+    bounds = np.concatenate(([0], starts, [len(values)]))
+    return [(values[bounds[i]], bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
@@ -1,38 +1,115 @@
 import pandas as pd
 import numpy as np
 import math
-from User import User
+import contextlib
+import copy
+from User import CompactUser
+from PrefMatrix import PrefMatrix
+from PrefCache import PairCache, ResultCache
+from DataLoader import Dataset, load_dataset, read_database, num_answer
+from QuestionCatalogue import QuestionCatalogue
+from Neighbours import check_mode, select_neighbours, distance_weights
+from Metrics import COUNT_BUCKETS
+import random
+import time as t
+
+# The norms produced for each block of the 1-5 scale, see norm_block.
+NORMS = {1: "Prohibition", 2: None, 3: "Permission"}
+
 
 class PrefPredict:
 
-    def __init__(self,max_dist, min_common, min_users_pred):
+    def __init__(self,max_dist, min_common, min_users_pred, data=None, path="main_data.csv", backend="dict",
+                 pair_cache=None, dataset=None, metrics=None, result_cache=None, segments=None, approx=None):
         """
         We load the database and prepare everything to make predictions
         :param max_dist: The maximum distance between to users for them to be considered similar
         :param min_common: The minimum ammount of commonly known preferences for assessing the distance between users
         :param min_users_pred: The minimum ammount of similar users required to make a prediction
+        :param data: An already parsed DataFrame of the database, if None the database is loaded from path (see
+        DataLoader.load_dataset)
+        :param path: The path of the privacy preferences database
+        :param backend: "dict" to compare users pair by pair, "matrix" to compare a user with the whole database
+        at once using a PrefMatrix
+        :param pair_cache: A cache for the common preferences of pairs of users (see PairCache), a new PairCache
+        if None. Its keys only depend on the preferences of the users, so it can be shared between instances.
+        :param dataset: An already loaded DataLoader.Dataset, it takes precedence over data and path
+        :param metrics: A Metrics.Metrics instance to record timings and counters of the batch predictions, None
+        to record nothing
+        :param result_cache: A ResultCache for the predictions of predict, norm_predict and predict_many, None to
+        always compute them. It can be shared between instances, its entries are tied to the version of the
+        dataset and those of other versions are dropped. They are also tied to the ammount of answers of the
+        predicted preferences, so appending users (see appended) only invalidates the entries of the preferences they
+        answered.
+        :param segments: A Demographics.SegmentIndex of the database users, so the batch predictions of a query
+        with a segment search its users first, None to always search everybody
+        :param approx: A ClusterIndex.ClusterIndex of the database users for an approximate search of similar
+        users: only those in the clusters closest to the query are compared with it. None for the exact search
         """
+        if backend not in ("dict", "matrix"):
+            raise ValueError(f"Unknown backend {backend}")
+        self.backend = backend
+        # These thresholds are only the defaults, every prediction function accepts its own values.
         self.max_dist = max_dist
         self.min_common = min_common
         self.min_users_pred = min_users_pred
-        # We read the privacy preferences database.
-        self.data = pd.read_csv("main_data.csv", encoding="ISO-8859-1", low_memory=False)
-        # There are 1737 participants in the database, we list their ids.
-        self.user_ids = list(range(1, 1738))
-        # The database has some errors in a few participants that break the code when making predictions.
-        # We remove these participants.
-        problematic_users = [168, 204, 218, 322, 795, 1124, 1153, 1154, 1240, 1445]
-        for pu in problematic_users:
-            self.user_ids.remove(pu)
+        self.path = path
+        # We load the privacy preferences database, unless the caller already did it for us. The loader uses a
+        # binary cache of the parsed preferences, so the csv is only parsed when it changes.
+        if dataset is None:
+            if data is None:
+                dataset = load_dataset(path)
+            else:
+                dataset = Dataset.from_frame(data)
+        self.dataset = dataset
+        # The DataFrame is only read if somebody asks for it, see the data property.
+        self._data = data
+        # The ids of the participants in the database, the problematic ones were removed by the loader.
+        self.user_ids = list(dataset.user_ids)
         # We build the ids of the privacy preferences, these are the id of the question in the survey they come from
         # e.g. "Q12_1".
         self.preference_ids = self.get_preference_ids()
+        # The preferences as a dense array, row i is self.database_users[i].
+        self.matrix = PrefMatrix(dataset.values, self.preference_ids)
         # To access the preference knowleddge in the database we will use the list of their users.
         self.database_users = []
         # We fill this list.
         self.build_database_users()
-        # This dictionary is used to avoid calculating common known preference between users more than once.
-        self.common_prefs = {}
+        # The questions of the survey grouped by kind, to draw them without looking at the database.
+        self.catalogue = QuestionCatalogue(dataset.questions, self.preference_ids)
+        # This cache is used to avoid calculating common known preference between users more than once.
+        # It is bounded, so anonymous users created for every request are eventually evicted.
+        self.pair_cache = pair_cache if pair_cache is not None else PairCache()
+        self.segments = segments
+        self.approx = approx
+        self.result_cache = result_cache
+        if result_cache is not None:
+            result_cache.set_version(dataset.version)
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.histogram("neighbours", "Similar users found for each predicted preference.", COUNT_BUCKETS)
+            metrics.counter("select_batches_total", "Batches of candidates scored by select_norms.")
+            metrics.counter("select_budget_exhausted_total", "Calls to select_norms that ran out of time.")
+            metrics.counter("segment_fallbacks_total", "Predictions whose segment had too few similar users.")
+            metrics.counter("approx_fallbacks_total",
+                            "Predictions whose probed clusters had too few users knowing the preference.")
+
+    def span(self, name):
+        """
+        Times a step with self.metrics, if there are metrics.
+        :param name: The name of the step
+        :return: A context manager
+        """
+        return self.metrics.span(name) if self.metrics is not None else contextlib.nullcontext()
+
+    @property
+    def data(self):
+        """
+        The DataFrame of the database, read the first time it is needed.
+        """
+        if self._data is None:
+            self._data = read_database(self.path)
+        return self._data
 
     def get_preference_ids(self):
         """
@@ -40,25 +117,62 @@ class PrefPredict:
         names of the questions from which the preferences were gathered, for example, "Q12_1".
         :return: A list of strings.
         """
-        preference_ids = []
-        for id in self.data.columns:
-            #Only questions up to Q147 are related to preferences, later questions are related to demografics.
-            if int(id.split("_")[0].replace("Q", ""))<148:
-                preference_ids.append(id)
-        return preference_ids
+        return list(self.dataset.preference_ids)
 
     def build_database_users(self):
         """
         This function loads the preferences from the database as User instances into self.database_users.
         """
-        for u_id in self.user_ids:
-            user = User(u_id)
-            for p_id in self.preference_ids:
-                #if the preference is not Nan we add it to the known preferences of the user.
-                if not pd.isna(self.data.loc[user.get_id(), p_id]):
-                    #Before adding it, we parse the preference from string to numerical form.
-                    user.add_pref(p_id, self.num_answer(self.data.loc[user.get_id(), p_id]))
-            self.database_users.append(user)
+        for row, u_id in enumerate(self.user_ids):
+            # The preferences were already parsed to numerical form by the loader, the users are views of the
+            # rows of the matrix so they take almost no memory.
+            self.database_users.append(CompactUser(self.matrix, u_id, self.matrix.values[row],
+                                                   self.matrix.known[row]))
+
+    def appended(self, answers, demographics=None, log_offset=None):
+        """
+        Returns an instance with the users of this one followed by some new ones, e.g. respondents ingested
+        while the server runs. This instance is not modified and everything that does not depend on the users
+        is shared, so the cost is proportional to the new answers rather than to the size of the database (see
+        PrefMatrix.appended). The new users get the ids following the last one.
+        :param answers: A list with a dictionary {preference id: value in the scale 1-5} per new user, ids
+        that are not preferences of the database and values outside the scale are ignored
+        :param demographics: A list with a dictionary of demographics (see Demographics.FIELDS) per new user,
+        or None if they are unknown
+        :param log_offset: The offset of the ingestion log the new users were read up to, see
+        DataLoader.IngestLog
+        :return: A PrefPredict instance
+        """
+        if demographics is None:
+            demographics = [None] * len(answers)
+        pref_index = self.matrix.pref_index
+        values = np.zeros((len(answers), len(self.preference_ids)), dtype=np.int8)
+        for row, user_answers in enumerate(answers):
+            for p_id, val in user_answers.items():
+                if p_id in pref_index and val in (1, 2, 3, 4, 5):
+                    values[row, pref_index[p_id]] = val
+        new = copy.copy(self)
+        new.matrix = self.matrix.appended(values)
+        first = self.user_ids[-1] + 1 if self.user_ids else 1
+        new_ids = list(range(first, first + len(answers)))
+        new.user_ids = self.user_ids + new_ids
+        new.database_users = list(self.database_users)
+        for row in range(len(self.user_ids), len(new.user_ids)):
+            new.database_users.append(CompactUser(new.matrix, new.user_ids[row], new.matrix.values[row],
+                                                  new.matrix.known[row]))
+        # Every new user has an entry, even if their demographics are unknown. Their ids follow those of the
+        # participants, demographics.csv has no row for them (see Demographics.read_demographics).
+        known_demographics = dict(self.dataset.demographics)
+        known_demographics.update((u_id, d or {}) for u_id, d in zip(new_ids, demographics))
+        # The DataFrame of the database (see data) only holds the users of the csv
+        new.dataset = Dataset(new.matrix.values, self.preference_ids, new.user_ids, self.dataset.questions,
+                              self.dataset.version, self.dataset.log_offset if log_offset is None else log_offset,
+                              demographics=known_demographics, participants=self.dataset.participants)
+        if self.segments is not None:
+            new.segments = self.segments.appended([d or {} for d in demographics])
+        if self.approx is not None:
+            new.approx = self.approx.appended(values, len(self.user_ids))
+        return new
 
     def find_valid_users(self, pref_id):
         """
@@ -68,124 +182,168 @@ class PrefPredict:
         :param pref_id: A string id of the preference we are checking.
         :return: A list of User instances
         """
-        validusers = []
-        for user in self.database_users:
-            if user.has_pref(pref_id):
-                validusers.append(user)
-        return validusers
+        # The rows of these users are precomputed in the index of self.matrix, we do not need to check them all.
+        return [self.database_users[row] for row in self.matrix.valid_rows(pref_id)]
 
     def num_answer(self, ans):
         """
         In the database the answers to the survey questions are in text for (e.g. "completely unacceptable")
-        Thi function transforms them into numbers from 1-5 as follows:
-        completely unacceptable -> 1, unacceptable -> 2, neutral -> 3, acceptable -> 4, completely acceptable -> 5
+        Thi function transforms them into numbers from 1-5, see DataLoader.num_answer.
         :param ans: A string containing the answer from the dataset
-        :return: An integer representing the anser, as detailed above
-        """
-        ans = ans.lower().replace(" ", "")
-        num = math.nan
-        if "unacceptable" in ans:
-            if "completely" in ans:
-                #This is the case "completely unacceptable"
-                num = 1
-            else:
-                # This is the case "unacceptable"
-                num = 2
-        elif "acceptable" in ans:
-            if "completely" in ans:
-                # This is the case "completely acceptable"
-                num = 5
-            else:
-                # This is the case "unacceptable"
-                num = 4
-        if "neutral" in ans:
-            # This is the case "neutral"
-            num = 3
-        return num
+        :return: An integer representing the anser
+        """
+        return num_answer(ans)
 
     def common_known_prefs(self, user1, user2):
         """
         Given two User instances, this function computes their commonly known preferences, i.e. those which we
-        already know for both users. To avoid computing it more than once, it saves the list of preference ids
-        for their commonly known preferences into the dictionary self.common_prefs.
+        already know for both users. To avoid computing it more than once, it saves the preference ids of their
+        commonly known preferences, and the sum of the differences between them, into self.pair_cache.
         :param user1: A User instance.
         :param user2: A User instance.
         :return: An integer with the ammount of common preferences.
         """
-        if user1 not in self.common_prefs:
-            self.common_prefs[user1] = {}
-        if user2 not in self.common_prefs[user1]:
-            self.common_prefs[user1][user2] = []
+        return len(self.pair_stats(user1, user2)[0])
+
+    def pair_stats(self, user1, user2):
+        """
+        Returns the commonly known preferences of two users and the sum of the absolute differences between
+        them, from self.pair_cache when possible.
+        :param user1: A User instance.
+        :param user2: A User instance.
+        :return: A tuple (common, dis), a tuple of preference ids and an integer
+        """
+        key = self.pair_cache.pair_key(user1, user2)
+        stats = self.pair_cache.get(key)
+        if stats is None:
             #for p_id in self.preference_ids:
             #    if user1.has_pref(p_id) and user2.has_pref(p_id):
-            #        self.common_prefs[user1][user2].append(p_id)
-            for p_id in set(user1.known_pref).intersection(set(user2.known_pref)):
-                self.common_prefs[user1][user2].append(p_id)
-
-        return len(self.common_prefs[user1][user2])
+            #        common.append(p_id)
+            if isinstance(user1, CompactUser) and isinstance(user2, CompactUser) and \
+                    user1.columns.pref_index is user2.columns.pref_index and not user1.extra and not user2.extra:
+                # Both users are arrays over the same columns, we compare them at once.
+                both = np.flatnonzero(user1.known & user2.known)
+                common = tuple(user1.columns.preference_ids[col] for col in both.tolist())
+                dis = int(np.abs(user1.values[both].astype(np.int16) - user2.values[both]).sum())
+            else:
+                common = tuple(set(user1.known_pref_fields()).intersection(set(user2.known_pref_fields())))
+                dis = 0
+                # For each of their commonly known preferences we calculate their difference and add it up
+                for p_id in common:
+                    dis += abs(user1.get_pref(p_id) - user2.get_pref(p_id))
+            stats = (common, dis)
+            self.pair_cache.put(key, stats)
+        return stats
 
-    def distance(self, user1, user2):
+    def distance(self, user1, user2, min_common=None):
         """
         This function returns the distance between two users, this is the average diference between
-        their commonly known preferences. This function makes use of the variable self.min_common,
+        their commonly known preferences. This function makes use of the variable min_common,
         this is an integer of the minimum ammount of common known variables, if the ammount is lower
         we consider we have not enough information and assess the distance as infinity.
         :param user1: A User instance.
         :param user2: A User instance.
+        :param min_common: The minimum ammount of common preferences, self.min_common if None
         :return: A float, the distance between user1 and user2.
         """
-        numcommon = self.common_known_prefs(user1, user2)
-        if numcommon >= self.min_common:
+        if min_common is None:
+            min_common = self.min_common
+        common, dis = self.pair_stats(user1, user2)
+        numcommon = len(common)
+        if numcommon >= min_common:
             #If the users do have the minimum required ammount of common preferences
-            dis = 0
-            #For each of their commonly known preferences we calculate their difference and add it to the distance
-            for p_id in self.common_prefs[user1][user2]:
-                dis += abs(user1.get_pref(p_id) - user2.get_pref(p_id))
-            #We average the distance
+            #We average the sum of the differences of their commonly known preferences
             dis = dis / float(numcommon)
         else:
             #If the users do not have the minimum required ammount of common preferences
             dis = math.inf
         return dis
 
-    def list_similar_users(self, user1, pred_pref_id = None):
+    def list_similar_users(self, user1, pred_pref_id = None, max_dist=None, min_common=None, min_users_pred=None,
+                           neighbour_mode="radius"):
         """
         Finds the users in the database for which we known their preference toward the
         targeted pred_pref_id preference we want to predict, and returns a list of those
         considered similar to user1
         :param user1: A User instance
         :param pred_pref_id: A targeted prefernce to predict
+        :param max_dist: The maximum distance for similar users, self.max_dist if None
+        :param min_common: The minimum ammount of common preferences, self.min_common if None
+        :param min_users_pred: The minimum ammount of similar users, self.min_users_pred if None
+        :param neighbour_mode: How similar users are chosen, one of Neighbours.MODES
         :return: A list of User instances, those similar with user1 and for which
-        we know their preference toward pred_pref_id
+        we know their preference toward pred_pref_id, and the list of their distances with user1
         """
-        retdis = []
-        distances = {}
-        similarusers = []
+        max_dist, min_common, min_users_pred = self.thresholds(max_dist, min_common, min_users_pred)
+        if self.backend == "matrix":
+            return self.matrix_similar_users(user1, pred_pref_id, max_dist, min_common, min_users_pred,
+                                             neighbour_mode)
         # If a preference id is provided we will only check the userss for which we know that preference
         # Otherwise all users are considered
-        if pred_pref_id:
+        if self.approx is not None:
+            # Only those in the clusters closest to user1
+            rows = self.approx_rows(user1, pred_pref_id, min_users_pred)
+            listusers = [self.database_users[row] for row in rows]
+        elif pred_pref_id:
             listusers = self.find_valid_users(pred_pref_id)
         else:
             listusers = self.database_users
 
         # We calculate the distance between the provided user1 and all (valid) users
-        for user2 in listusers:
-            distances[user2] = self.distance(user1, user2)
-            # If the distance is lower than the threshold, we consider the users to be similar
-            if distances[user2] <= self.max_dist:
-                    similarusers.append(user2)
-                    retdis.append(distances[user2])
+        distances = [self.distance(user1, user2, min_common) for user2 in listusers]
+        # If the distance is lower than the threshold, we consider the users to be similar.
         # If the number of similar users is lower than the required threshold to make predictions
         # We add the ones that are the most similar (even if they have larger distance than max_dist)
         # Until we have enough similar users
-        if len(similarusers) < self.min_users_pred:
-            for i in range(self.min_users_pred-len(similarusers)):
-                key = min(distances, key=distances.get)
-                similarusers.append(key)
-                retdis.append(distances.pop(key))
-        return similarusers, retdis
+        similar = select_neighbours(np.array(distances), max_dist, min_users_pred, neighbour_mode)
+        return [listusers[i] for i in similar], [distances[i] for i in similar]
 
-    def predict(self, user, pref_id, conf = True, rho = 0.5, mu = 0.5):
+    def matrix_similar_users(self, user1, pred_pref_id, max_dist, min_common, min_users_pred,
+                             neighbour_mode="radius"):
+        """
+        Same as list_similar_users, but the distances with all the (valid) users are computed at once with
+        self.matrix. The similar users are returned in the same order list_similar_users returns them.
+        :param user1: A User instance
+        :param pred_pref_id: A targeted prefernce to predict
+        :param max_dist: The maximum distance for similar users
+        :param min_common: The minimum ammount of common preferences
+        :param min_users_pred: The minimum ammount of similar users
+        :param neighbour_mode: How similar users are chosen, one of Neighbours.MODES
+        :return: A list of User instances and the list of their distances with user1
+        """
+        if self.approx is not None:
+            rows = self.approx_rows(user1, pred_pref_id, min_users_pred)
+        elif pred_pref_id:
+            rows = self.matrix.valid_rows(pred_pref_id)
+        else:
+            rows = np.arange(self.matrix.num_users())
+        cols, vals = self.matrix.encode(user1)
+        distances = self.matrix.distances(cols, vals, min_common, rows)
+        similar = select_neighbours(distances, max_dist, min_users_pred, neighbour_mode)
+        return [self.database_users[row] for row in rows[similar]], distances[similar].tolist()
+
+    def approx_rows(self, user, pref_id=None, min_users_pred=0):
+        """
+        Returns the rows of the database users in the clusters of self.approx closest to a user, those that
+        the approximate search compares with them. If there are less than min_users_pred of them, those of the
+        exact search are returned instead.
+        :param user: A User instance
+        :param pref_id: A string id of a preference, only the users that know it are returned, None for all
+        :param min_users_pred: The minimum ammount of similar users
+        :return: An array of rows, in database order
+        """
+        cols, vals = self.matrix.encode(user)
+        rows = self.approx.candidates(cols, vals)
+        if pref_id:
+            rows = rows[self.matrix.known[rows, self.matrix.pref_index[pref_id]]]
+        if len(rows) >= min_users_pred:
+            return rows
+        if self.metrics is not None:
+            self.metrics.inc("approx_fallbacks_total")
+        return self.matrix.valid_rows(pref_id) if pref_id else np.arange(self.matrix.num_users())
+
+    def predict(self, user, pref_id, conf = True, rho = 0.5, mu = 0.5, max_dist=None, min_common=None,
+                min_users_pred=None, neighbour_mode="radius"):
         """
         Given a user instance and a preference id, this function predicts the preference of the user.
         :param user: A User instance.
@@ -194,32 +352,88 @@ class PrefPredict:
         :param rho: A confidence weight, specifically the weight of the distance with the similar users
         :param mu: A confidence weight, that of the standard deviation of the aggregated preferences to make the
         prediction
+        :param max_dist: The maximum distance for similar users, self.max_dist if None
+        :param min_common: The minimum ammount of common preferences, self.min_common if None
+        :param min_users_pred: The minimum ammount of similar users, self.min_users_pred if None
+        :param neighbour_mode: How similar users are chosen and aggregated, one of Neighbours.MODES
         :return: A tuple (float, float), the first is the predicted preference in the scale 1-5
         (1: completly unacceptable, 5:completely acceptaable), the second the confidence in 0-1 (0 meaning no
         confidence, 1 complete confidence).
         """
+        if self.result_cache is not None:
+            key = self.result_key(user, [pref_id], rho, mu, max_dist, min_common, min_users_pred, neighbour_mode)
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                return (float(cached[0, 0]), float(cached[0, 1])) if conf else float(cached[0, 0])
         # We build a list of the database users that are similar with the user and for which we know
         # their preference for pref_id.
-        similar_users, dis = self.list_similar_users(user, pref_id)
+        similar_users, dis = self.list_similar_users(user, pref_id, max_dist, min_common, min_users_pred,
+                                                     neighbour_mode)
         # We gather their preferences for the targeted id and put them into a list
         ans = []
         for sim_u in similar_users:
             ans.append(sim_u.get_pref(pref_id))
         # The predicted preference is the average of those we gathered
+        pred, std = self.aggregate(ans, dis, neighbour_mode)
         # We also calculate the preference confidence and return it if required
-        if conf:
+        if conf or self.result_cache is not None:
             #We calculate the part referring to the weight of the distance
             rhopart = min(1.0, sum(dis)/len(dis))
             #And the part referring to the standard deviation of the aggregated preferences
-            mupart = min(1.0, float(np.std(ans)))
+            mupart = min(1.0, std)
             #The confidence is the weighted sum of both parts
             confidence = 1 - rho * rhopart - mu * mupart
-            ret = (sum(ans)/float(len(ans)), confidence)
+        if self.result_cache is not None:
+            self.result_cache.put(key, np.array([[pred, confidence, len(similar_users)]], dtype=float),
+                                  self.dataset.version)
+        if conf:
+            ret = (pred, confidence)
         else:
-            ret = sum(ans)/float(len(ans))
+            ret = pred
         return ret
 
-    def norm_predict(self, user, pref_id, useconf=True, rho=0.5, mu=0.5):
+    def result_key(self, user, pref_ids, rho=0.5, mu=0.5, max_dist=None, min_common=None, min_users_pred=None,
+                   neighbour_mode="radius", segment=None):
+        """
+        Returns the key of the predictions of some preferences of a user in self.result_cache, see
+        ResultCache.result_key.
+        :param user: A User instance
+        :param pref_ids: A list of string ids of the targeted preferences
+        :return: A bytes digest
+        """
+        max_dist, min_common, min_users_pred = self.thresholds(max_dist, min_common, min_users_pred)
+        if self.segments is None:
+            # Without an index every segment gives the same predictions
+            segment = None
+        # Only the users that answered a preference can be similar users for it, so the predictions of a
+        # preference only change when somebody answering it is appended.
+        answer_counts = self.matrix.answer_counts
+        pref_index = self.matrix.pref_index
+        counts = [int(answer_counts[pref_index[p_id]]) if p_id in pref_index else 0 for p_id in pref_ids]
+        approx = self.approx.key() if self.approx is not None else None
+        return ResultCache.result_key(user.fingerprint(), pref_ids, max_dist, min_common, min_users_pred, rho, mu,
+                                      neighbour_mode, self.dataset.version, segment, counts, approx)
+
+    def aggregate(self, ans, dis, neighbour_mode="radius"):
+        """
+        Aggregates the preferences of the similar users into a prediction.
+        :param ans: A list with the preferences of the similar users for the targeted preference
+        :param dis: A list with the distances of the similar users
+        :param neighbour_mode: One of Neighbours.MODES, in "weighted" mode closer users weight more
+        :return: A tuple (pred, std), the (weighted) average and standard deviation of the preferences
+        """
+        if neighbour_mode != "weighted":
+            return sum(ans) / float(len(ans)), float(np.std(ans))
+        weights = distance_weights(dis)
+        if weights.sum() == 0:
+            # All the similar users are infinitely far, they all count the same.
+            weights = np.ones(len(ans))
+        pred = float(np.average(ans, weights=weights))
+        std = float(np.sqrt(np.average((np.asarray(ans) - pred) ** 2, weights=weights)))
+        return pred, std
+
+    def norm_predict(self, user, pref_id, useconf=True, rho=0.5, mu=0.5, max_dist=None, min_common=None,
+                     min_users_pred=None, neighbour_mode="radius"):
         """
         This function transforms numeric preferences into norms. It devides the preference scale 1-5 into three
         blocks relating to prohibition, unclear preference (no norm generated), and permission.
@@ -229,38 +443,319 @@ class PrefPredict:
         :param rho: A confidence weight, specifically the weight of the distance with the similar users
         :param mu: A confidence weight, that of the standard deviation of the aggregated preferences to make the
         prediction
+        :param max_dist: The maximum distance for similar users, self.max_dist if None
+        :param min_common: The minimum ammount of common preferences, self.min_common if None
+        :param min_users_pred: The minimum ammount of similar users, self.min_users_pred if None
+        :param neighbour_mode: How similar users are chosen and aggregated, one of Neighbours.MODES
+        :return: An integer 1-3, representing 1:prohibition, 2:unclear preference (no norm produced), 3:permission
+        """
+        # The prediction and its confidence are those of predict (possibly cached)
+        pred, conf = self.predict(user, pref_id, True, rho, mu, max_dist, min_common, min_users_pred,
+                                  neighbour_mode)
+        #We always return confidence, even if we are not using it in the formula, norm_block takes care of it
+        norm = NORMS[self.norm_block(pred, conf, useconf)]
+        return (pred, conf, norm)
+
+    def norm_block(self, pred, conf, useconf=True):
+        """
+        Finds the block of the 1-5 scale a prediction falls in, as used by norm_predict to produce norms.
+        The blocks get larger the more confident the prediction is.
+        :param pred: A float representing a preference in [1,5]
+        :param conf: A float representing the prediction confidence in [0,1]
+        :param useconf: A boolean indicating if we should use confidence in the prediction function
         :return: An integer 1-3, representing 1:prohibition, 2:unclear preference (no norm produced), 3:permission
         """
-        # We build a list of the database users that are similar with the user and for which we know
-        # their preference for pref_id.
-        similar_users, dis = self.list_similar_users(user, pref_id)
-        # We gather their preferences for the targeted id and put them into a list
-        ans = []
-        for sim_u in similar_users:
-            ans.append(sim_u.get_pref(pref_id))
-        # The predicted preference is the average of those we gathered
-        pred = sum(ans) / float(len(ans))
-        # If needed for the prediction, we also calculate the confidence
-        #We calculate the part referring to the weight of the distance
-        rhopart = min(1.0, sum(dis)/len(dis))
-        #And the part referring to the standard deviation of the aggregated preferences
-        mupart = min(1.0, float(np.std(ans)))
-        #The confidence is the weighted sum of both parts
-        conf = 1 - rho * rhopart - mu * mupart
-        #We always return confidence, even if we are not using it in the formula, hence we need another variable
         formulaconf = conf
         if not useconf:
             #If we are not using confidence, the prediction function would be the same as considering confiddence 0.5
             formulaconf = 0.5
         #If the prediction is within the neutral block of the 1-5 scale, we do not produce any norm
-        norm = None
+        block = 2
         if pred < 2 + formulaconf:
             #If the prediction is within the disagree block of the scale, we produce a prohibition norm
-            norm = "Prohibition"
+            block = 1
         if pred > 4 - formulaconf:
             # If the prediction is within the agree block of the scale, we produce a permission norm
-            norm = "Permission"
-        return (pred, conf, norm)
+            block = 3
+        return block
+
+    def norm_blocks(self, pred, conf, useconf=True):
+        """
+        Vectorized version of norm_block.
+        :param pred: An array of predicted preferences
+        :param conf: An array with their confidences
+        :param useconf: A boolean indicating if we should use confidence in the prediction function
+        :return: An integer array with the block of each prediction
+        """
+        formulaconf = np.asarray(conf) if useconf else 0.5
+        pred = np.asarray(pred)
+        block = np.full(len(pred), 2)
+        block[pred < 2 + formulaconf] = 1
+        # As in norm_block, a permission overrides a prohibition
+        block[pred > 4 - formulaconf] = 3
+        return block
+
+    def thresholds(self, max_dist=None, min_common=None, min_users_pred=None):
+        """
+        Fills the thresholds that were not given for a call with the defaults of this instance.
+        :param max_dist: The maximum distance for similar users or None
+        :param min_common: The minimum ammount of common preferences or None
+        :param min_users_pred: The minimum ammount of similar users or None
+        :return: A tuple (max_dist, min_common, min_users_pred)
+        """
+        if max_dist is None:
+            max_dist = self.max_dist
+        if min_common is None:
+            min_common = self.min_common
+        if min_users_pred is None:
+            min_users_pred = self.min_users_pred
+        return max_dist, min_common, min_users_pred
+
+    def predict_many(self, user, pref_ids=None, rho=0.5, mu=0.5, max_dist=None, min_common=None,
+                     min_users_pred=None, neighbour_mode="radius", segment=None, search=None):
+        """
+        Predicts many preferences of a user at once. The distances between the user and the database users are
+        computed a single time and shared by all the targeted preferences. The results are those of predict,
+        up to floating point rounding.
+        :param user: A User instance.
+        :param pref_ids: A list of string ids of the targeted preferences, all the unknown preferences of the
+        user if None
+        :param rho: A confidence weight, specifically the weight of the distance with the similar users
+        :param mu: A confidence weight, that of the standard deviation of the aggregated preferences to make the
+        prediction
+        :param max_dist: The maximum distance for similar users, self.max_dist if None
+        :param min_common: The minimum ammount of common preferences, self.min_common if None
+        :param min_users_pred: The minimum ammount of similar users, self.min_users_pred if None
+        :param neighbour_mode: How similar users are chosen and aggregated, one of Neighbours.MODES
+        :param segment: The demographic segment of the user, see predict_encoded
+        :param search: A dict shared by the calls for the same user, see neighbour_stats
+        :return: A DataFrame indexed by preference id, with the predicted preference "pred" in the scale 1-5,
+        its confidence "conf" in 0-1 and the ammount of similar users "neighbours" used for the prediction
+        """
+        if pref_ids is None:
+            pref_ids = [p_id for p_id in self.preference_ids if not user.has_pref(p_id)]
+        if search is None:
+            cols, vals = self.matrix.encode(user)
+        else:
+            if "query" not in search:
+                search["query"] = self.matrix.encode(user)
+            cols, vals = search["query"]
+        if self.result_cache is None:
+            return self.predict_encoded(cols, vals, pref_ids, rho, mu, max_dist, min_common, min_users_pred,
+                                        neighbour_mode, segment=segment, search=search)
+        # The predictions of the whole call are a single entry of the cache
+        key = self.result_key(user, pref_ids, rho, mu, max_dist, min_common, min_users_pred, neighbour_mode, segment)
+        rows = self.result_cache.get(key)
+        if rows is None:
+            computed = self.predict_encoded(cols, vals, pref_ids, rho, mu, max_dist, min_common, min_users_pred,
+                                            neighbour_mode, segment=segment, search=search)
+            # Its columns are those of the entry, pred, conf and neighbours
+            self.result_cache.put(key, computed.to_numpy(dtype=float), self.dataset.version)
+            return computed
+        return pd.DataFrame({"pred": rows[:, 0], "conf": rows[:, 1], "neighbours": rows[:, 2].astype(int)},
+                            index=pd.Index(pref_ids, name="pref_id"))
+
+    def predict_encoded(self, cols, vals, pref_ids, rho=0.5, mu=0.5, max_dist=None, min_common=None,
+                        min_users_pred=None, neighbour_mode="radius", exclude=None, segment=None, search=None):
+        """
+        Same as predict_many, for a query given by the columns and values of its known preferences in
+        self.matrix (see PrefMatrix.encode) instead of a User instance.
+        :param cols: An array with the columns of the known preferences of the query
+        :param vals: An array with the values of the query for those columns
+        :param pref_ids: A list of string ids of the targeted preferences
+        :param rho: A confidence weight, specifically the weight of the distance with the similar users
+        :param mu: A confidence weight, that of the standard deviation of the aggregated preferences to make the
+        prediction
+        :param max_dist: The maximum distance for similar users, self.max_dist if None
+        :param min_common: The minimum ammount of common preferences, self.min_common if None
+        :param min_users_pred: The minimum ammount of similar users, self.min_users_pred if None
+        :param neighbour_mode: How similar users are chosen and aggregated, one of Neighbours.MODES
+        :param exclude: A row or array of rows of the database that cannot be similar users, e.g. the row of the
+        query itself when predicting a database user (leave-one-out)
+        :param segment: The demographic segment of the query (see Demographics.SegmentIndex.segment), its users
+        are searched first. If None, or there is no segment index, the whole database is searched.
+        :param search: A dict shared by the calls for the same query, see neighbour_stats
+        :return: The DataFrame of predict_many
+        """
+        max_dist, min_common, min_users_pred = self.thresholds(max_dist, min_common, min_users_pred)
+        check_mode(neighbour_mode)
+        targets = np.array([self.matrix.pref_index[p_id] for p_id in pref_ids], dtype=np.intp)
+        with self.span("neighbour_search"):
+            mask = None
+            if segment is not None and self.segments is not None:
+                mask = self.segments.mask(segment)
+            if mask is None:
+                count, pred, std, mean_dis = self.neighbour_stats(cols, vals, targets, max_dist, min_common,
+                                                                  min_users_pred, neighbour_mode, exclude,
+                                                                  search=search)
+            else:
+                count, pred, std, mean_dis = self.neighbour_stats(cols, vals, targets, max_dist, min_common,
+                                                                  min_users_pred, neighbour_mode, exclude, mask,
+                                                                  search)
+                # Where the segment has too few similar users (or only users without enough common
+                # preferences), we look in the whole database.
+                fallback = np.flatnonzero((count < min_users_pred) | ~np.isfinite(mean_dis))
+                if len(fallback):
+                    stats = self.neighbour_stats(cols, vals, targets[fallback], max_dist, min_common,
+                                                 min_users_pred, neighbour_mode, exclude, search=search)
+                    for part, fixed in zip((count, pred, std, mean_dis), stats):
+                        part[fallback] = fixed
+                    if self.metrics is not None:
+                        self.metrics.inc("segment_fallbacks_total", len(fallback))
+        if self.metrics is not None:
+            self.metrics.observe_many("neighbours", count, mode=neighbour_mode)
+        with self.span("confidence"):
+            # The confidence is computed as in predict
+            confidence = 1 - rho * np.minimum(1.0, mean_dis) - mu * np.minimum(1.0, std)
+            return pd.DataFrame({"pred": pred, "conf": confidence, "neighbours": count.astype(int)},
+                                index=pd.Index(pref_ids, name="pref_id"))
+
+    def neighbour_stats(self, cols, vals, targets, max_dist, min_common, min_users_pred, neighbour_mode="radius",
+                        exclude=None, mask=None, search=None):
+        """
+        Finds the similar users of a query for many targets and aggregates their preferences, see
+        PrefMatrix.neighbour_stats. With the approximate search, the targets known by less than min_users_pred
+        users of the probed clusters are searched in the whole database.
+        :param cols: An array with the columns of the known preferences of the query
+        :param vals: An array with the values of the query for those columns
+        :param targets: An array with the columns of the targeted preferences
+        :param max_dist: The maximum distance for similar users
+        :param min_common: The minimum ammount of common preferences
+        :param min_users_pred: The minimum ammount of similar users
+        :param neighbour_mode: One of Neighbours.MODES
+        :param exclude: A row or array of rows of the database that cannot be similar users
+        :param mask: A boolean array with an entry per row, only the rows where it is True can be similar
+        users, e.g. those of a segment. All the rows if None
+        :param search: None, or a dict shared by several calls with the same query, min_common and exclude (e.g.
+        the batches of select_norms) where the distances are kept, sorted, to compute them a single time. Its
+        entry "targets" holds the columns of all the targets of those calls. predict_many keeps the encoded
+        query in it as well.
+        :return: The tuple (count, mean, std, mean_dis) of PrefMatrix.neighbour_stats
+        """
+        ranking, knowing = self._ranking(cols, vals, targets, min_common, exclude, mask, search,
+                                         self.approx is not None)
+        stats = self.matrix.neighbour_stats(None, targets, max_dist, min_users_pred, mode=neighbour_mode,
+                                            ranking=ranking)
+        if self.approx is not None:
+            # Where the probed clusters have too few users knowing the target, we search the whole database (or
+            # segment) instead, as approx_rows does.
+            fallback = np.flatnonzero(knowing[targets] < min_users_pred)
+            if len(fallback):
+                ranking = self._ranking(cols, vals, targets, min_common, exclude, mask, search, False)[0]
+                exact = self.matrix.neighbour_stats(None, targets[fallback], max_dist, min_users_pred,
+                                                    mode=neighbour_mode, ranking=ranking)
+                for part, fixed in zip(stats, exact):
+                    part[fallback] = fixed
+                if self.metrics is not None:
+                    self.metrics.inc("approx_fallbacks_total", len(fallback))
+        return stats
+
+    def _ranking(self, cols, vals, targets, min_common, exclude, mask, search, approx):
+        # The users that can be similar to the query sorted by distance (see PrefMatrix.rank) and, if approx, how
+        # many of them know each preference. They are kept in search, if given.
+        key = ("global" if mask is None else "segment", approx)
+        if search is not None and key in search:
+            return search[key]
+        if approx:
+            # With the approximate search, those in the clusters closest to the query. Those that know none of
+            # the targets are never chosen, there is no need to leave them out first.
+            rows = self.approx.candidates(cols, vals)
+            if mask is not None:
+                rows = rows[mask[rows]]
+        else:
+            # Only the users that know some of the targets (and are in the mask) can be similar users
+            rows = self.matrix.rows_for_any(targets if search is None else search["targets"], mask)
+        if exclude is not None:
+            rows = rows[~np.isin(rows, exclude)]
+        ranking = self.matrix.rank(self.matrix.distances(cols, vals, min_common, rows), rows)
+        knowing = self.matrix.count_known(rows) if approx else None
+        if search is not None:
+            search[key] = (ranking, knowing)
+        return ranking, knowing
+
+    def norm_predict_many(self, user, pref_ids=None, useconf=True, rho=0.5, mu=0.5, max_dist=None,
+                          min_common=None, min_users_pred=None, neighbour_mode="radius", segment=None):
+        """
+        Batch version of norm_predict, see predict_many.
+        :param user: A User instance.
+        :param pref_ids: A list of string ids of the targeted preferences, all the unknown preferences of the
+        user if None
+        :param useconf: A boolean indicating if we should use confidence in the prediction function
+        :param rho: A confidence weight, specifically the weight of the distance with the similar users
+        :param mu: A confidence weight, that of the standard deviation of the aggregated preferences to make the
+        prediction
+        :param max_dist: The maximum distance for similar users, self.max_dist if None
+        :param min_common: The minimum ammount of common preferences, self.min_common if None
+        :param min_users_pred: The minimum ammount of similar users, self.min_users_pred if None
+        :param neighbour_mode: How similar users are chosen and aggregated, one of Neighbours.MODES
+        :param segment: The demographic segment of the user, see predict_encoded
+        :return: The DataFrame of predict_many with an extra column "norm", "Prohibition", "Permission" or None
+        """
+        ret = self.predict_many(user, pref_ids, rho, mu, max_dist, min_common, min_users_pred, neighbour_mode,
+                                segment)
+        blocks = self.norm_blocks(ret["pred"], ret["conf"], useconf)
+        ret["norm"] = pd.Series([NORMS[block] for block in blocks], index=ret.index, dtype=object)
+        return ret
+
+    def select_norms(self, user, k=3, pref_ids=None, mode="top", budget=None, chunk=64, useconf=True, rho=0.5,
+                     mu=0.5, max_dist=None, min_common=None, min_users_pred=None, neighbour_mode="radius",
+                     rng=random, segment=None):
+        """
+        Chooses k preferences of the user for which a norm (prohibition or permission) is predicted. The
+        candidates are scored in batches with predict_many, in random order, until all of them are scored or
+        the time budget is spent. The distances with the database users are computed and sorted a single time,
+        only their aggregation is done per batch. If there are less than k norms among the scored candidates,
+        the most confident unclear predictions complete the selection, so this function always returns.
+        :param user: A User instance.
+        :param k: The ammount of preferences to choose
+        :param pref_ids: A list of string ids of the candidate preferences, all the unknown preferences of the
+        user if None
+        :param mode: "top" to choose the k most confident norms, "sample" to choose k norms at random
+        :param budget: The seconds that can be spent scoring candidates, None to score all of them. At least one
+        batch is always scored.
+        :param chunk: The ammount of candidates scored in each batch
+        :param useconf: A boolean indicating if we should use confidence in the prediction function
+        :param rho: A confidence weight, specifically the weight of the distance with the similar users
+        :param mu: A confidence weight, that of the standard deviation of the aggregated preferences to make the
+        prediction
+        :param max_dist: The maximum distance for similar users, self.max_dist if None
+        :param min_common: The minimum ammount of common preferences, self.min_common if None
+        :param min_users_pred: The minimum ammount of similar users, self.min_users_pred if None
+        :param neighbour_mode: How similar users are chosen and aggregated, one of Neighbours.MODES
+        :param rng: The random number generator to use
+        :param segment: The demographic segment of the user, see predict_encoded
+        :return: The DataFrame of predict_many for the chosen preferences, with an extra column "block" as
+        returned by norm_block
+        """
+        if mode not in ("top", "sample"):
+            raise ValueError(f"Unknown mode {mode}")
+        start = t.perf_counter()
+        if pref_ids is None:
+            pref_ids = [p_id for p_id in self.preference_ids if not user.has_pref(p_id)]
+        pref_ids = rng.sample(list(pref_ids), len(pref_ids))
+        search = {"targets": np.array([self.matrix.pref_index[p_id] for p_id in pref_ids], dtype=np.intp)}
+        scored = []
+        for first in range(0, len(pref_ids), chunk):
+            scored.append(self.predict_many(user, pref_ids[first:first + chunk], rho, mu, max_dist, min_common,
+                                            min_users_pred, neighbour_mode, segment, search))
+            if self.metrics is not None:
+                self.metrics.inc("select_batches_total")
+            if budget is not None and t.perf_counter() - start >= budget:
+                if self.metrics is not None and first + chunk < len(pref_ids):
+                    self.metrics.inc("select_budget_exhausted_total")
+                break
+        scored = pd.concat(scored) if scored else self.predict_many(user, [])
+        scored["block"] = self.norm_blocks(scored["pred"], scored["conf"], useconf)
+        norms = scored[scored["block"] != 2]
+        if mode == "top":
+            # A stable sort keeps the random order among equally confident predictions.
+            norms = norms.sort_values("conf", ascending=False, kind="stable")
+        # Otherwise the candidates were shuffled, so the first ones are a random sample
+        chosen = norms.iloc[:k]
+        if len(chosen) < k:
+            unclear = scored[scored["block"] == 2].sort_values("conf", ascending=False, kind="stable")
+            chosen = pd.concat([chosen, unclear.iloc[:k - len(chosen)]])
+        return chosen
 
     def getUser(self, id):
         return self.database_users[id]
@@ -294,6 +789,8 @@ if __name__ == "__main__":
     #ex_user.add_pref("Q67_10",5)
     #Predict the preference for the user to an unknown preference id
     #print(pred.predict(ex_user, 'Q68_1'))
-    for id in pred.getPrefIds():
-        if not ex_user.has_pref(id):
-            print(str(id)+":"+str(pred.norm_predict(ex_user, id)))
\ No newline at end of file
+    #for id in pred.getPrefIds():
+    #    if not ex_user.has_pref(id):
+    #        print(str(id)+":"+str(pred.norm_predict(ex_user, id)))
+    #Or predict all the unknown preferences of the user at once
+    print(pred.norm_predict_many(ex_user).to_string())
\ No newline at end of file
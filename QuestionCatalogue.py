@@ -0,0 +1,63 @@
+import random
+
+# The kinds of questions by ammount of answers, each is recognised by the text of its first option.
+QUESTION_TYPES = {10: "Your Parents", 5: "Assistant Provider", 6: "No conditions"}
+
+
+class QuestionCatalogue:
+
+    def __init__(self, questions, preference_ids):
+        """
+        Groups the questions of the survey by their ammount of answers and keeps their text, so questions can
+        be drawn at random without looking at the database.
+        :param questions: A dictionary with the text of every column of the database, e.g. Dataset.questions
+        :param preference_ids: A list with the ids of the preferences, e.g. "Q12_1"
+        """
+        self.preference_ids = list(preference_ids)
+        # The full text of each preference
+        self.texts = {p_id: questions[p_id] for p_id in self.preference_ids}
+        # The text of each question (the part before the options), by question name, e.g. "Q12"
+        self.prompts = {}
+        # The names of the questions of each kind, by ammount of answers, and the kind of each question
+        self.groups = {num_answers: [] for num_answers in QUESTION_TYPES}
+        self.kinds = {}
+        for p_id in self.preference_ids:
+            q_name = p_id.split("_")[0]
+            if q_name in self.prompts or f"{q_name}_1" not in questions:
+                continue
+            self.prompts[q_name] = questions[p_id].split(":")[0]
+            for num_answers, option in QUESTION_TYPES.items():
+                if questions[f"{q_name}_1"].find(option) >= 0:
+                    self.groups[num_answers].append(q_name)
+                    self.kinds[q_name] = num_answers
+                    break
+
+    def sample(self, num_answers, prev="Q0", rng=random):
+        """
+        Draws a random question with the given ammount of answers.
+        :param num_answers: The ammount of answers, one of the keys of QUESTION_TYPES
+        :param prev: The name of a question that must not be drawn again, only for 5 and 6 answers
+        :param rng: The random number generator to use
+        :return: A tuple (question name, question text)
+        """
+        group = self.groups[num_answers]
+        # Questions with 10 answers are only asked once, so they never exclude the previous one.
+        if num_answers != 10 and len(group) > 1 and self.kinds.get(prev) == num_answers:
+            # We draw among all the questions but one, and replace prev by that one if we get it.
+            q_name = group[rng.randrange(len(group) - 1)]
+            if q_name == prev:
+                q_name = group[-1]
+        elif group:
+            q_name = group[rng.randrange(len(group))]
+        else:
+            raise ValueError(f"There are no questions with {num_answers} answers")
+        return q_name, self.prompts[q_name]
+
+    def random_preference(self, rng=random):
+        """
+        Draws a random preference among all the preferences of the survey.
+        :param rng: The random number generator to use
+        :return: A tuple (preference id, preference text)
+        """
+        p_id = self.preference_ids[rng.randrange(len(self.preference_ids))]
+        return p_id, self.texts[p_id]
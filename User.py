@@ -1,3 +1,7 @@
+import hashlib
+import numpy as np
+
+
 class User:
 
     def __init__(self, num=None):
@@ -7,6 +11,8 @@ class User:
         """
         self.id = num
         self.known_pref = {}
+        # The fingerprint is computed when first needed and forgotten when the preferences change.
+        self._fingerprint = None
 
     def add_pref(self, p_id, pref_val):
         """
@@ -15,6 +21,7 @@ class User:
         :param pref_val: The numerical value of the preference
         """
         self.known_pref[p_id] = pref_val
+        self._fingerprint = None
 
     def get_pref(self, p_id):
         """
@@ -45,3 +52,129 @@ class User:
         :return: An id
         """
         return self.id
+
+    def fingerprint(self):
+        """
+        Returns a stable fingerprint of the known preferences of the User, two users with the same known
+        preferences have the same fingerprint regardless of their ids or the order the preferences were added.
+        :return: A bytes digest
+        """
+        if self._fingerprint is None:
+            items = sorted(self.known_pref.items())
+            self._fingerprint = hashlib.blake2b(repr(items).encode(), digest_size=16).digest()
+        return self._fingerprint
+
+
+class CompactUser:
+
+    __slots__ = ("id", "columns", "values", "known", "extra", "_fingerprint")
+
+    def __init__(self, columns, num=None, values=None, known=None):
+        """
+        Same as User, storing the preferences in a fixed-length int8 array with a mask of the known ones
+        instead of a dictionary. The columns are shared by all the users, so a user only takes two small arrays,
+        or two views of the rows of a PrefMatrix for database users.
+        :param columns: The mapping of preference ids to positions in the arrays, any object with the
+        preference_ids list and the pref_index dictionary of a PrefMatrix (e.g. the PrefMatrix itself)
+        :param num: An id for the user
+        :param values: An int8 array with the preferences, one per column, new zeros if None
+        :param known: A boolean array, True where the preference is known, values > 0 if None
+        """
+        self.id = num
+        self.columns = columns
+        if values is None:
+            values = np.zeros(len(columns.preference_ids), dtype=np.int8)
+        self.values = values
+        self.known = values > 0 if known is None else known
+        # Preferences that do not fit the arrays (unknown ids, values that are not small integers), rare
+        self.extra = None
+        self._fingerprint = None
+
+    def add_pref(self, p_id, pref_val):
+        """
+        Adds a known preference to the User's profile
+        :param p_id: the id of the preference to add
+        :param pref_val: The numerical value of the preference
+        """
+        col = self.columns.pref_index.get(p_id)
+        if col is not None and float(pref_val).is_integer() and -128 <= pref_val <= 127:
+            self._own_arrays()
+            self.values[col] = pref_val
+            self.known[col] = True
+            if self.extra is not None:
+                self.extra.pop(p_id, None)
+        else:
+            if col is not None and self.known[col]:
+                self._own_arrays()
+                self.known[col] = False
+            if self.extra is None:
+                self.extra = {}
+            self.extra[p_id] = pref_val
+        self._fingerprint = None
+
+    def _own_arrays(self):
+        if not (self.values.flags.owndata and self.known.flags.owndata):
+            # The arrays are views of a shared matrix, we copy them before writing
+            self.values = np.array(self.values)
+            self.known = np.array(self.known)
+
+    def get_pref(self, p_id):
+        """
+        Returns the requested preference
+        :param p_id: The id of the requested preference
+        :return: The value of the requested preference
+        """
+        col = self.columns.pref_index.get(p_id)
+        if col is not None and self.known[col]:
+            return int(self.values[col])
+        if self.extra is not None and p_id in self.extra:
+            return self.extra[p_id]
+        raise KeyError(p_id)
+
+    def has_pref(self, p_id):
+        """
+        Checks if the preference of the User towards p_id is known
+        :param p_id: The id of the preference to check
+        :return: A boolean, True if the preference is known, False otherwise.
+        """
+        col = self.columns.pref_index.get(p_id)
+        if col is not None and self.known[col]:
+            return True
+        return self.extra is not None and p_id in self.extra
+
+    def known_pref_fields(self):
+        """
+        Returns a list of the known preferences of the User
+        :return: A list of the ids of known preferences for the User, in column order
+        """
+        preference_ids = self.columns.preference_ids
+        fields = [preference_ids[col] for col in np.flatnonzero(self.known).tolist()]
+        if self.extra:
+            fields.extend(self.extra)
+        return fields
+
+    def known_cols(self):
+        """
+        Returns the columns and values of the known preferences that are stored in the arrays.
+        :return: A tuple (cols, vals) of arrays
+        """
+        cols = np.flatnonzero(self.known)
+        return cols, self.values[cols].astype(np.int16)
+
+    def get_id(self):
+        """
+        Returns the id of the user, assigned when instantiated
+        :return: An id
+        """
+        return self.id
+
+    def fingerprint(self):
+        """
+        Returns a stable fingerprint of the known preferences of the User, the same a User with the same known
+        preferences has.
+        :return: A bytes digest
+        """
+        if self._fingerprint is None:
+            items = sorted((p_id, self.get_pref(p_id)) for p_id in self.known_pref_fields())
+            self._fingerprint = hashlib.blake2b(repr(items).encode(), digest_size=16).digest()
+        return self._fingerprint
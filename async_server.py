@@ -0,0 +1,302 @@
+#! /usr/bin/env python3
+"""
+Asynchronous (ASGI) version of server.py, with the same /questions, /predict and /metrics endpoints.
+
+The predictions run in a bounded pool of processes, so a slow one does not hold the others behind the GIL.
+Requests beyond the pending limit are refused with 503, those not answered in time get a 504, and concurrent
+requests with the same uid and answers share a single computation. Run it with any ASGI server, e.g.:
+
+    uvicorn async_server:app --port 5000
+
+It is configured with environment variables: NORM_PREDICTION_DATA (the database), NORM_PREDICTION_WORKERS
+(processes, one per core by default), NORM_PREDICTION_MAX_PENDING (predictions queued or running, 4 per worker
+by default) and NORM_PREDICTION_TIMEOUT (seconds, 5 by default). With NORM_PREDICTION_CACHE_RESULTS set the
+predictions are cached, and with NORM_PREDICTION_RESULT_CACHE (a sqlite file) they are also kept across restarts
+and shared by the workers. With NORM_PREDICTION_DEMOGRAPHICS (the path of demographics.csv) requests with
+demographics look for similar users in their segment first. With NORM_PREDICTION_INGEST set, the answers posted
+to /ingest are added to the database: this process writes them to the ingestion log and the workers append them
+when they next check it. NORM_PREDICTION_APPROX_CLUSTERS and NORM_PREDICTION_APPROX_PROBE enable the approximate
+search of similar users, see ClusterIndex.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import time as t
+import urllib.parse
+from PredictEngine import get_engine
+from Metrics import queue_logger
+from NormService import questions_payload, predict_payload, profile_key, ingest_payload
+
+DATA = os.environ.get("NORM_PREDICTION_DATA", "main_data.csv")
+WORKERS = int(os.environ.get("NORM_PREDICTION_WORKERS", os.cpu_count() or 1))
+MAX_PENDING = int(os.environ.get("NORM_PREDICTION_MAX_PENDING", 4 * WORKERS))
+TIMEOUT = float(os.environ.get("NORM_PREDICTION_TIMEOUT", 5))
+CACHE_RESULTS = bool(os.environ.get("NORM_PREDICTION_CACHE_RESULTS"))
+RESULT_CACHE = os.environ.get("NORM_PREDICTION_RESULT_CACHE")
+DEMOGRAPHICS = os.environ.get("NORM_PREDICTION_DEMOGRAPHICS")
+INGEST = bool(os.environ.get("NORM_PREDICTION_INGEST"))
+APPROX_CLUSTERS = int(os.environ.get("NORM_PREDICTION_APPROX_CLUSTERS", 0)) or None
+APPROX_PROBE = int(os.environ.get("NORM_PREDICTION_APPROX_PROBE", 8))
+
+# The engine of this process draws the questions. With the fork start method the workers inherit it, so the
+# matrix is shared copy-on-write, otherwise each worker loads it (memory-mapping the binary cache).
+engine = get_engine(DATA, cache_results=CACHE_RESULTS, result_cache_path=RESULT_CACHE, demographics_path=DEMOGRAPHICS,
+                    approx_clusters=APPROX_CLUSTERS, approx_probe=APPROX_PROBE)
+metrics = engine.metrics
+metrics.counter("coalesced_total", "Predictions answered with the computation of an identical request.")
+metrics.counter("rejected_total", "Predictions refused because too many were pending.")
+metrics.counter("timeouts_total", "Predictions not answered in time.")
+log = queue_logger("norm_prediction")
+
+
+def _predict_job(path, args):
+    """
+    Makes the predictions of a /predict request, in a worker process.
+    :param path: The path of the database
+    :param args: A dictionary with the request parameters
+    :return: A tuple (payload, predict_out, control_out, timings, changes, caches), timings being the spans of
+    the request, changes the metrics it recorded in the worker (see Metrics.snapshot) and caches the counters of
+    the caches of the worker
+    """
+    worker_engine = get_engine(path, cache_results=CACHE_RESULTS, result_cache_path=RESULT_CACHE,
+                               demographics_path=DEMOGRAPHICS, approx_clusters=APPROX_CLUSTERS,
+                               approx_probe=APPROX_PROBE)
+    before = worker_engine.metrics.snapshot()
+    with worker_engine.metrics.trace() as timings:
+        with worker_engine.metrics.span("dataset"):
+            pred = worker_engine.current()
+        text_out, predict_out, control_out = predict_payload(pred, args)
+    changes = worker_engine.metrics.snapshot(since=before)
+    result_cache = worker_engine.result_cache
+    caches = {"pair_cache": worker_engine.pair_cache.stats(), "worker": os.getpid(),
+              "result_cache": result_cache.stats() if result_cache is not None else {}}
+    return text_out, predict_out, control_out, timings, changes, caches
+
+
+class Overloaded(Exception):
+    """
+    Raised when a prediction is refused because too many are pending.
+    """
+    pass
+
+
+class _Flight:
+
+    def __init__(self):
+        """
+        A computation in progress and the ammount of requests waiting for it.
+        """
+        self.task = None
+        self.waiters = 0
+
+
+class PredictionPool:
+
+    def __init__(self, path=DATA, workers=WORKERS, max_pending=MAX_PENDING, timeout=TIMEOUT):
+        """
+        Runs the predictions of the requests in a pool of processes, with a bounded ammount of pending
+        predictions and coalescing identical requests.
+        :param path: The path of the database
+        :param workers: The ammount of processes
+        :param max_pending: The maximum ammount of distinct predictions queued or running, more are refused
+        :param timeout: The seconds a request waits for its prediction
+        """
+        self.path = path
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.executor = None
+        # Only as many predictions as workers are submitted, the others wait here and can still be dropped.
+        self.slots = None
+        self.flights = {}
+        # The counters of the caches of each worker, as of its last prediction
+        self.caches = {}
+        metrics.gauge("pending", "Distinct predictions queued or running.", lambda: {(): len(self.flights)})
+        # The predictions use the caches of the workers, not those of this process.
+        metrics.gauge("pair_cache", "Counters of the cache of pairs of users, by worker.",
+                      lambda: self.cache_stats("pair_cache"))
+        metrics.gauge("result_cache", "Counters of the cache of predictions, by worker.",
+                      lambda: self.cache_stats("result_cache"))
+
+    def start(self):
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(self.workers,
+                                                                   mp_context=multiprocessing.get_context())
+            self.slots = asyncio.Semaphore(self.workers)
+
+    def stop(self):
+        if self.executor is not None:
+            if sys.version_info >= (3, 9):
+                self.executor.shutdown(wait=False, cancel_futures=True)
+            else:
+                # Python 3.8 cannot cancel the queued predictions, the workers finish them
+                self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def cache_stats(self, name):
+        """
+        The counters of a cache of every worker as labelled gauge values, see Metrics.gauge.
+        :param name: "pair_cache" or "result_cache"
+        """
+        return {(("stat", stat), ("worker", worker)): value for worker, caches in list(self.caches.items())
+                for stat, value in caches[name].items()}
+
+    async def predict(self, args):
+        """
+        Makes the predictions of a /predict request, sharing the computation with the pending identical ones.
+        :param args: A dictionary with the request parameters
+        :return: The tuple of _predict_job
+        :raise Overloaded: If too many predictions are pending
+        :raise asyncio.TimeoutError: If the prediction took longer than the timeout
+        """
+        self.start()
+        key = profile_key(args)
+        flight = self.flights.get(key)
+        if flight is not None:
+            metrics.inc("coalesced_total")
+        else:
+            if len(self.flights) >= self.max_pending:
+                metrics.inc("rejected_total")
+                raise Overloaded()
+            flight = self.flights[key] = _Flight()
+            flight.task = asyncio.ensure_future(self._compute(key, flight, args))
+            # Nobody may be left to see how it ended
+            flight.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        flight.waiters += 1
+        try:
+            # The computation is shielded, a request that times out does not cancel it for the others.
+            return await asyncio.wait_for(asyncio.shield(flight.task), self.timeout)
+        except asyncio.TimeoutError:
+            metrics.inc("timeouts_total")
+            raise
+        finally:
+            flight.waiters -= 1
+
+    async def _compute(self, key, flight, args):
+        try:
+            async with self.slots:
+                if flight.waiters == 0:
+                    # Everybody waiting for it timed out while it was queued
+                    raise asyncio.TimeoutError()
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(self.executor, _predict_job, self.path, args)
+                # The metrics recorded in the worker are added to those of this process, once per computation
+                # even if it is shared by several requests.
+                changes, caches = result[4:]
+                metrics.merge(changes)
+                self.caches[caches.pop("worker")] = caches
+                return result
+        finally:
+            del self.flights[key]
+
+
+pool = PredictionPool()
+
+
+def _json(status, payload):
+    # the same compact and sorted JSON as flask.jsonify
+    body = (json.dumps(payload, sort_keys=True, separators=(",", ":")) + "\n").encode()
+    return status, "application/json", body
+
+
+def _args(scope, body=b""):
+    # the first value of each parameter, as flask's request.args[...] (or request.values with a form) gives
+    args = {}
+    for text in (scope["query_string"], body):
+        for name, value in urllib.parse.parse_qsl(text.decode("latin-1"), keep_blank_values=True):
+            args.setdefault(name, value)
+    return args
+
+
+async def _body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+def questions():
+    with metrics.span("questions"):
+        text_out, uid = questions_payload(engine.current().catalogue)
+    log.info(f"sent {uid}")
+    return _json(200, text_out)
+
+
+async def predict(args):
+    start = t.perf_counter()
+    try:
+        text_out, predict_out, control_out, timings = (await pool.predict(args))[:4]
+    except Overloaded:
+        return _json(503, {"error": "too many pending predictions, retry later"})
+    except asyncio.TimeoutError:
+        return _json(504, {"error": "the prediction took too long"})
+    except KeyError as e:
+        return _json(400, {"error": f"missing parameter {e}"})
+    elapsed = t.perf_counter() - start
+    # The spans of the worker are in span_seconds already
+    metrics.observe("span_seconds", elapsed, span="predict")
+    timings = dict(timings, predict=elapsed)
+    spans = " ".join(f"{name}={1000 * seconds:.1f}ms" for name, seconds in timings.items())
+    log.info(f"{predict_out} [{spans}]")
+    log.info(control_out)
+    return _json(200, text_out)
+
+
+async def ingest(args):
+    with metrics.span("ingest"):
+        try:
+            # Writing the log, and compacting it now and then, would block the other requests, it runs in a thread.
+            loop = asyncio.get_running_loop()
+            text_out, ingest_out = await loop.run_in_executor(None, ingest_payload, engine, args)
+        except (KeyError, ValueError) as e:
+            return _json(400, {"error": str(e)})
+    log.info(ingest_out)
+    return _json(200, text_out)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            pool.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            pool.stop()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    The ASGI application.
+    """
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    if INGEST and scope["path"] == "/ingest":
+        if scope["method"] != "POST":
+            status, content_type, body = _json(405, {"error": "method not allowed"})
+        else:
+            status, content_type, body = await ingest(_args(scope, await _body(receive)))
+    elif scope["method"] != "GET":
+        status, content_type, body = _json(405, {"error": "method not allowed"})
+    elif scope["path"] == "/questions":
+        status, content_type, body = questions()
+    elif scope["path"] == "/predict":
+        status, content_type, body = await predict(_args(scope))
+    elif scope["path"] == "/metrics":
+        status, content_type, body = 200, "text/plain; version=0.0.4; charset=utf-8", metrics.render().encode()
+    else:
+        status, content_type, body = _json(404, {"error": "not found"})
+    headers = [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+    if status == 503:
+        headers.append((b"retry-after", b"1"))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
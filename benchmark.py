@@ -0,0 +1,440 @@
+#! /usr/bin/env python3
+"""
+Benchmarks of loading the database, single and batch predictions, the approximate and segment searches and the HTTP
+endpoints.
+
+Run it on the real database or on a synthetic one, results are printed (or written) as JSON so runs can be
+compared over time:
+
+    python benchmark.py --data main_data.csv --output results.json
+    python benchmark.py --synthetic-users 100000 --synthetic-questions 147
+
+With --check-backends it checks instead that the pair by pair and the matrix backends predict the same:
+
+    python benchmark.py --data main_data.csv --check-backends 200
+
+and with --check-approx that the approximate search (see ClusterIndex) always predicts, even when the probed
+clusters have few users knowing the targeted preferences:
+
+    python benchmark.py --data main_data.csv --check-approx 200
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time as t
+import numpy as np
+import pandas as pd
+from ClusterIndex import ClusterIndex
+from DataLoader import load_dataset
+from Demographics import SegmentIndex
+from Metrics import Metrics
+from PrefPredict import PrefPredict
+from User import User
+
+# The option texts used for each kind of synthetic question, the first one identifies the kind
+SYNTHETIC_OPTIONS = {
+    10: ["Your Parents", "Your Partner", "Your Siblings", "Your Children", "Your Friends", "Your Colleagues",
+         "Your Neighbours", "Your Landlord", "Your Doctor", "Your Bank"],
+    5: ["Assistant Provider", "Skill Provider", "Advertisers", "Government", "Researchers"],
+    6: ["No conditions", "If anonymised", "If notified", "If consented", "If deleted after use", "If encrypted"],
+}
+ANSWERS = ["Completely unacceptable", "Unacceptable", "Neutral", "Acceptable", "Completely acceptable"]
+BENCHMARKS = ("load", "predict", "batch", "http", "approx", "segments")
+
+
+def generate_database(path, num_users, num_questions=147, answered=20, seed=0, chunk=10000):
+    """
+    Writes a synthetic database with the layout of main_data.csv: a first row with the text of the questions,
+    then one row per user with Likert answers to some of the questions. Users have a general attitude and
+    answer around it, so they have neighbours.
+    :param path: The path of the csv file to write
+    :param num_users: The ammount of users
+    :param num_questions: The ammount of preference questions, at most 147
+    :param answered: The ammount of questions answered by each user
+    :param seed: The seed of the random number generator
+    :param chunk: The ammount of users generated and written at once
+    """
+    if not 0 < num_questions <= 147:
+        raise ValueError("There can be between 1 and 147 preference questions")
+    rng = np.random.default_rng(seed)
+    columns = []
+    texts = []
+    # The question (0 based) of each column
+    column_question = []
+    for q in range(1, num_questions + 1):
+        for i, option in enumerate(SYNTHETIC_OPTIONS[(10, 5, 6)[q % 3]]):
+            columns.append(f"Q{q}_{i + 1}")
+            texts.append(f"Would you share the information of scenario {q}?: {option}")
+            column_question.append(q - 1)
+    # A demographic question, it is not a preference
+    columns.append("Q148")
+    texts.append("What is your age?")
+    labels = np.array(ANSWERS + [np.nan], dtype=object)
+    pd.DataFrame([texts], columns=columns).to_csv(path, index=False)
+    answered = min(answered, num_questions)
+    for start in range(0, num_users, chunk):
+        size = min(chunk, num_users - start)
+        # Each user answers all the options of a random set of questions
+        picks = np.argsort(rng.random((size, num_questions)), axis=1)[:, :answered]
+        known = np.zeros((size, num_questions), dtype=bool)
+        known[np.arange(size)[:, None], picks] = True
+        known = known[:, column_question]
+        attitude = rng.integers(0, 5, size=(size, 1))
+        codes = np.clip(attitude + rng.integers(-1, 2, size=known.shape), 0, 4)
+        # 5 means unknown, it is written as an empty cell
+        codes[~known] = 5
+        frame = pd.DataFrame(labels[codes], columns=columns[:-1])
+        frame["Q148"] = rng.integers(18, 80, size=size)
+        frame.to_csv(path, mode="a", header=False, index=False)
+
+
+def summarize(samples):
+    """
+    Summarizes the durations of repeated runs.
+    :param samples: A list of durations in seconds
+    :return: A dictionary with the count, the total, the mean and percentiles in milliseconds and the throughput
+    in runs per second
+    """
+    ms = np.array(samples) * 1000
+    return {"count": len(samples), "total_s": float(ms.sum() / 1000), "mean_ms": float(ms.mean()),
+            "p50_ms": float(np.percentile(ms, 50)), "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99)), "min_ms": float(ms.min()), "max_ms": float(ms.max()),
+            "throughput_per_s": float(len(samples) / ms.sum() * 1000) if ms.sum() > 0 else None}
+
+
+def measure(fn, repeat, warmup=1):
+    """
+    Times fn repeatedly.
+    :param fn: A function without arguments
+    :param repeat: The ammount of timed runs
+    :param warmup: The ammount of runs before timing
+    :return: A list of durations in seconds
+    """
+    for i in range(warmup):
+        fn()
+    samples = []
+    for i in range(repeat):
+        start = t.perf_counter()
+        fn()
+        samples.append(t.perf_counter() - start)
+    return samples
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory of this process so far, in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+def bench_load(path, repeat):
+    """
+    Times parsing the csv, loading the binary cache, building a PrefPredict from a loaded dataset and, within
+    it, build_database_users.
+    """
+    results = {}
+    results["parse_csv"] = summarize(measure(lambda: load_dataset(path, cache=False), repeat, warmup=0))
+    # The first cached load writes the cache, the following ones map it
+    load_dataset(path)
+    results["load_cached"] = summarize(measure(lambda: load_dataset(path), repeat))
+    dataset = load_dataset(path)
+    results["build_predictor"] = summarize(measure(lambda: PrefPredict(0, 5, 5, dataset=dataset), repeat,
+                                                   warmup=0))
+    pred = PrefPredict(0, 5, 5, dataset=dataset)
+
+    def build_users():
+        pred.database_users = []
+        pred.build_database_users()
+    results["build_database_users"] = summarize(measure(build_users, repeat, warmup=0))
+    return results
+
+
+def random_queries(pred, count, rng):
+    """
+    Picks database users and one of their unknown preferences to predict.
+    :return: A list of tuples (User instance, preference id)
+    """
+    queries = []
+    for i in range(count):
+        user = pred.getUser(rng.randrange(len(pred.database_users)))
+        unknown = [p_id for p_id in pred.getPrefIds() if not user.has_pref(p_id)]
+        queries.append((user, rng.choice(unknown)))
+    return queries
+
+
+def bench_predict(pred, repeat, rng, backends):
+    """
+    Times predict and norm_predict of one preference, with each of the given backends.
+    """
+    results = {}
+    for backend in backends:
+        pred.backend = backend
+        # Different queries each time, otherwise the dict backend would find its pairs in the cache
+        it = iter(random_queries(pred, repeat + 1, rng))
+        results[f"predict_{backend}"] = summarize(measure(lambda: pred.predict(*next(it)), repeat))
+        it = iter(random_queries(pred, repeat + 1, rng))
+        results[f"norm_predict_{backend}"] = summarize(measure(lambda: pred.norm_predict(*next(it)), repeat))
+    pred.backend = "matrix"
+    return results
+
+
+def bench_batch(pred, repeat, rng):
+    """
+    Times norm_predict_many of all the unknown preferences of a user.
+    """
+    users = [user for user, p_id in random_queries(pred, repeat + 1, rng)]
+    it = iter(users)
+    return {"norm_predict_many": summarize(measure(lambda: pred.norm_predict_many(next(it)), repeat))}
+
+
+def partial_queries(pred, count, rng, answers=32, targets=64):
+    """
+    Picks database users and keeps only some of their answers, as the users of /predict, with some of their
+    unknown preferences to predict, all of them if targets is None.
+    :return: A list of tuples (User instance, list of preference ids)
+    """
+    queries = []
+    for n in range(count):
+        source = pred.getUser(rng.randrange(len(pred.database_users)))
+        known = sorted(source.known_pref_fields())
+        user = User(-1 - n)
+        for p_id in rng.sample(known, min(answers, len(known))):
+            user.add_pref(p_id, source.get_pref(p_id))
+        unknown = [p_id for p_id in pred.preference_ids if not user.has_pref(p_id)]
+        queries.append((user, unknown if targets is None else rng.sample(unknown, min(targets, len(unknown)))))
+    return queries
+
+
+def bench_approx(pred, repeat, rng, clusters=256, probes=(1, 4, 16)):
+    """
+    Times predict_many of all the unknown preferences of users with only some answers, with the exact search
+    and with the approximate one (see ClusterIndex) probing each ammount of clusters. Only the candidates are
+    read, so the time should follow their share of the database.
+    """
+    index = ClusterIndex.build(pred.dataset.values, clusters, seed=rng.randrange(2 ** 32))
+    queries = partial_queries(pred, repeat + 1, rng, targets=None)
+    it = iter(queries)
+    results = {"exact": summarize(measure(lambda: pred.predict_many(*next(it)), repeat))}
+    for n_probe in probes:
+        metrics = Metrics()
+        approx = PrefPredict(pred.max_dist, pred.min_common, pred.min_users_pred, backend="matrix",
+                             dataset=pred.dataset, metrics=metrics,
+                             approx=ClusterIndex(index.centroids, index.lists, n_probe))
+        it = iter(queries)
+        results[f"probe_{n_probe}"] = summarize(measure(lambda: approx.predict_many(*next(it)), repeat))
+        candidates = [len(index.candidates(*approx.matrix.encode(user), n_probe)) for user, p_ids in queries]
+        results[f"probe_{n_probe}"]["candidates_share"] = float(np.mean(candidates) / pred.matrix.num_users())
+        results[f"probe_{n_probe}"]["fallbacks"] = sum(metrics.snapshot().get("approx_fallbacks_total",
+                                                                              {}).values())
+    return results
+
+
+def bench_segments(pred, repeat, rng, splits=(1, 4, 16)):
+    """
+    Times predict_many of all the unknown preferences of users with only some answers, searching a segment
+    first (see Demographics.SegmentIndex). The database is split in each ammount of equal segments, by row, so
+    the time should follow the size of the searched segment.
+    """
+    queries = partial_queries(pred, repeat + 1, rng, targets=None)
+    num_users = pred.matrix.num_users()
+    results = {}
+    for split in splits:
+        metrics = Metrics()
+        segments = SegmentIndex([(row % split,) for row in range(num_users)], by=("segment",))
+        by_segment = PrefPredict(pred.max_dist, pred.min_common, pred.min_users_pred, backend="matrix",
+                                 dataset=pred.dataset, metrics=metrics, segments=segments)
+        it = iter(queries)
+        results[f"split_{split}"] = summarize(measure(lambda: by_segment.predict_many(*next(it), segment=(0,)),
+                                                      repeat))
+        results[f"split_{split}"]["segment_share"] = float(segments.mask((0,)).mean())
+        results[f"split_{split}"]["fallbacks"] = sum(metrics.snapshot().get("segment_fallbacks_total",
+                                                                            {}).values())
+    return results
+
+
+def bench_http(path, repeat, rng):
+    """
+    Times /questions and /predict through the Flask test client, /predict with random answers.
+    """
+    os.environ["NORM_PREDICTION_DATA"] = path
+    import server
+    client = server.app.test_client()
+    results = {"questions": summarize(measure(lambda: client.get("/questions"), repeat))}
+    requests = []
+    for i in range(repeat + 1):
+        uid = client.get("/questions").get_json()["uid"]
+        args = {"uid": uid}
+        for q, num_answers in enumerate((10, 5, 5, 6, 6)):
+            for a in range(1, num_answers + 1):
+                args[f"q{q}_{a}"] = str(rng.randint(1, 5))
+        requests.append(args)
+    it = iter(requests)
+    results["predict"] = summarize(measure(lambda: client.get("/predict", query_string=next(it)), repeat))
+    return results
+
+
+def check_backends(path, queries, rng, answers=32, targets=5):
+    """
+    Checks that both backends, and the batch predictions, give the same predictions and norms. The queries are
+    database users with only some of their answers, as the users of /predict, so there are few users within
+    max_dist and the fallback to the closest ones is exercised.
+    :param path: The path of the database
+    :param queries: The ammount of queries
+    :param rng: A random.Random instance
+    :param answers: The ammount of known answers of each query
+    :param targets: The ammount of predicted preferences of each query
+    :return: A dictionary with the ammount of compared predictions and of mismatches of each kind
+    """
+    by_dict = PrefPredict(0, 5, 5, path=path, backend="dict")
+    by_matrix = PrefPredict(0, 5, 5, path=path, backend="matrix", dataset=by_dict.dataset)
+    results = {"predictions": 0, "matrix_mismatches": 0, "batch_mismatches": 0}
+    for user, pref_ids in partial_queries(by_dict, queries, rng, answers, targets):
+        batch = by_matrix.predict_many(user, pref_ids)
+        for p_id in pref_ids:
+            expected = by_dict.predict(user, p_id)
+            norm = by_dict.norm_predict(user, p_id)
+            results["predictions"] += 1
+            if not np.allclose(by_matrix.predict(user, p_id), expected, rtol=1e-12, atol=0) or \
+                    by_matrix.norm_predict(user, p_id) != norm:
+                results["matrix_mismatches"] += 1
+            if not np.allclose(batch.loc[p_id, ["pred", "conf"]].to_numpy(float), expected, rtol=1e-12, atol=0):
+                results["batch_mismatches"] += 1
+    return results
+
+
+def check_approx(path, queries, rng, clusters=64, n_probe=1, answers=32, targets=5):
+    """
+    Checks that the approximate search gives a prediction (not NaN) for every targeted preference, with both
+    backends, single and batch predictions. Probing a single cluster of many small ones leaves few candidates,
+    so the fallback to the exact search is exercised.
+    :param path: The path of the database
+    :param queries: The ammount of queries, database users with only some of their answers
+    :param rng: A random.Random instance
+    :param clusters: The ammount of clusters of the index
+    :param n_probe: The ammount of probed clusters
+    :param answers: The ammount of known answers of each query
+    :param targets: The ammount of predicted preferences of each query
+    :return: A dictionary with the ammount of predictions, of fallbacks to the exact search, of NaN predictions
+    and of errors
+    """
+    metrics = Metrics()
+    by_dict = PrefPredict(0, 5, 5, path=path, backend="dict", metrics=metrics)
+    index = ClusterIndex.build(by_dict.dataset.values, clusters, n_probe, seed=rng.randrange(2 ** 32))
+    by_dict = PrefPredict(0, 5, 5, path=path, backend="dict", dataset=by_dict.dataset, metrics=metrics,
+                          approx=index)
+    by_matrix = PrefPredict(0, 5, 5, path=path, backend="matrix", dataset=by_dict.dataset, metrics=metrics,
+                            approx=index)
+    results = {"predictions": 0, "nan": 0, "errors": 0}
+    for user, pref_ids in partial_queries(by_dict, queries, rng, answers, targets):
+        try:
+            batch = by_matrix.predict_many(user, pref_ids)
+            values = [batch["pred"].to_numpy(float), batch["conf"].to_numpy(float)]
+            for pred in (by_dict, by_matrix):
+                for p_id in pref_ids:
+                    values.append(pred.predict(user, p_id))
+                    pred.norm_predict(user, p_id)
+        except ZeroDivisionError:
+            results["errors"] += 1
+            continue
+        results["predictions"] += 3 * len(pref_ids)
+        results["nan"] += int(np.isnan(np.concatenate(values)).sum())
+    results["fallbacks"] = sum(metrics.snapshot().get("approx_fallbacks_total", {}).values())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default="main_data.csv", help="the database to benchmark")
+    parser.add_argument("--synthetic-users", type=int, help="benchmark a synthetic database with this many users")
+    parser.add_argument("--synthetic-questions", type=int, default=147, help="questions of the synthetic database")
+    parser.add_argument("--answered", type=int, default=20, help="questions answered by each synthetic user")
+    parser.add_argument("--repeat", type=int, default=100, help="timed runs of each benchmark")
+    parser.add_argument("--load-repeat", type=int, default=3, help="timed runs of the load benchmarks")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="comma separated benchmarks to run")
+    parser.add_argument("--dict-backend", action="store_true", help="also time the pair by pair backend")
+    parser.add_argument("--check-backends", type=int, metavar="QUERIES",
+                        help="instead of timing, check that both backends predict the same for this many queries")
+    parser.add_argument("--check-approx", type=int, metavar="QUERIES",
+                        help="instead of timing, check that the approximate search always predicts for this many "
+                             "queries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    path = args.data
+    tmpdir = None
+    if args.synthetic_users:
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, "main_data.csv")
+        start = t.perf_counter()
+        generate_database(path, args.synthetic_users, args.synthetic_questions, args.answered, args.seed)
+        print(f"generated {args.synthetic_users} users in {t.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    if args.check_backends:
+        results = check_backends(path, args.check_backends, rng)
+        print(json.dumps(results, indent=2))
+        if tmpdir is not None:
+            tmpdir.cleanup()
+        sys.exit(1 if results["matrix_mismatches"] or results["batch_mismatches"] else 0)
+    if args.check_approx:
+        results = check_approx(path, args.check_approx, rng)
+        print(json.dumps(results, indent=2))
+        if tmpdir is not None:
+            tmpdir.cleanup()
+        sys.exit(1 if results["nan"] or results["errors"] else 0)
+
+    only = args.only.split(",")
+    results = {}
+    if "load" in only:
+        results["load"] = bench_load(path, args.load_repeat)
+        results["load"]["peak_rss_mb"] = peak_rss_mb()
+    pred = PrefPredict(0, 5, 5, path=path, backend="matrix")
+    if "predict" in only:
+        backends = ["matrix", "dict"] if args.dict_backend else ["matrix"]
+        results["predict"] = bench_predict(pred, args.repeat, rng, backends)
+        results["predict"]["peak_rss_mb"] = peak_rss_mb()
+    if "batch" in only:
+        results["batch"] = bench_batch(pred, args.repeat, rng)
+        results["batch"]["peak_rss_mb"] = peak_rss_mb()
+    if "http" in only:
+        # The server logs every request to stdout, which is where the report goes
+        with contextlib.redirect_stdout(sys.stderr):
+            results["http"] = bench_http(path, args.repeat, rng)
+        results["http"]["peak_rss_mb"] = peak_rss_mb()
+    if "approx" in only:
+        results["approx"] = bench_approx(pred, args.repeat, rng)
+        results["approx"]["peak_rss_mb"] = peak_rss_mb()
+    if "segments" in only:
+        results["segments"] = bench_segments(pred, args.repeat, rng)
+        results["segments"]["peak_rss_mb"] = peak_rss_mb()
+
+    report = {
+        "meta": {"timestamp": t.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                 "numpy": np.__version__, "pandas": pd.__version__, "platform": platform.platform(),
+                 "data": args.data if tmpdir is None else "synthetic", "users": len(pred.database_users),
+                 "preferences": len(pred.preference_ids), "repeat": args.repeat, "seed": args.seed},
+        "results": results,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()